@@ -9,16 +9,21 @@ from pandas import read_csv
 from joblib import Parallel, delayed
 
 from Kahi.KahiDb import KahiDb
+from Kahi.KahiPipeline import Pipeline, batched, transform_pool, transform_batch
+from Kahi.KahiJournal import RunJournal
+from Kahi.KahiWatcher import RawWatcher
+from queue import Queue, Empty
+from threading import Event
 
 
 
 
 class Kahi(KahiDb):
-    def __init__(self,dbserver_url="localhost",port=27017,colav_db="colav",db_suffix="_antioquia",ror_url='https://api.ror.org/organizations?affiliation=',n_jobs=12,verbose=0):
+    def __init__(self,dbserver_url="localhost",port=27017,colav_db="colav",db_suffix="_antioquia",ror_url='https://api.ror.org/organizations?affiliation=',ror_cache_file=None,ror_concurrency=10,ror_timeout=30,ror_dump=None,bulk_size=1000,entity_cache_size=100000,n_jobs=12,verbose=0):
         '''
         Class with the attributes and methods that will put the entire ETL process together
         '''
-        super().__init__(dbserver_url=dbserver_url,port=port,colav_db=colav_db,db_suffix=db_suffix,ror_url=ror_url,n_jobs=n_jobs,verbose=verbose)
+        super().__init__(dbserver_url=dbserver_url,port=port,colav_db=colav_db,db_suffix=db_suffix,ror_url=ror_url,ror_cache_file=ror_cache_file,ror_concurrency=ror_concurrency,ror_timeout=ror_timeout,ror_dump=ror_dump,bulk_size=bulk_size,entity_cache_size=entity_cache_size,n_jobs=n_jobs,verbose=verbose)
         
         self.data_articles=[]
         self.found_ids=[]
@@ -26,6 +31,7 @@ class Kahi(KahiDb):
         self.transformed=[] #articles in CoLav format
         self.loaded=[] #link to the ids of the loaded registers {document,author,institution,source}
         self.status={} #Marks the status of the process. For example: data cannot be loaded if its not linked
+        self.watch_stop=Event() #Finishes the watch loop
     
     #there should be different options to extract from files, lists or collections in mongo
     def extract_doi(self,data):
@@ -98,19 +104,9 @@ class Kahi(KahiDb):
         '''
         Transforms the data extracted in CoLav's format
         '''
-        parsed=[]
+        self.prefetch_languages(self.articles)
         for paper in self.articles:
-            entry={}
-            entry["document"]=self.parse_document(paper)
-            entry["author_institutions"]=self.parse_authors_institutions(paper)
-            entry["source"]=self.parse_source(paper)
-            parsed.append(entry)
-        for paper in parsed:
-            entry={}
-            entry["document"]=self.join_document(paper["document"])
-            entry["author_institutions"]=self.join_authors_institutions(paper["author_institutions"])
-            entry["source"]=self.join_source(paper["source"])
-            self.transformed.append(entry)
+            self.transformed.append(self.transform_one(paper))
 
     def transform_one(self,register):
         entry={}
@@ -122,8 +118,16 @@ class Kahi(KahiDb):
         entry["source"]=self.join_source(entry["source"])
         return entry
 
-    def parallel_transform(self):
-        self.transformed=Parallel(n_jobs=self.n_jobs,backend="threading",verbose=10)(delayed(self.transform_one)(reg) for reg in self.articles)
+    def parallel_transform(self,batch_size=100):
+        '''
+        Transforms the extracted data in a pool of n_jobs processes, the parsing is CPU-bound.
+        The processes are started with spawn (see transform_pool) and import the main module again,
+        so the script calling it must run Kahi inside an if __name__=="__main__": block,
+        otherwise every process would start the ETL again.
+        '''
+        with transform_pool(self.n_jobs) as executor:
+            result=executor.map(transform_batch,batched(self.articles,batch_size))
+            self.transformed=[reg for batch in result for reg in batch]
 
     def link(self):
         '''
@@ -141,6 +145,7 @@ class Kahi(KahiDb):
         self.transformed=linked
 
     def link_one(self,register):
+        self.prefetch_affiliations([register])
         entry={}
         entry["author_institutions"]=[]
         entry["document"]=register["document"]
@@ -150,35 +155,386 @@ class Kahi(KahiDb):
         
         return entry
     
-    def parallel_link(self):
-        result=Parallel(n_jobs=self.n_jobs,backend="threading",verbose=10)(delayed(self.link_one)(reg) for reg in self.transformed)
-        self.transformed=result
+    def link_batch(self,registers):
+        '''
+        Links a batch of transformed registers resolving first all their authors, institutions and sources
+        with one query per collection and lookup field, then the modifications are computed in memory.
+
+        Parameters
+        ----------
+        registers : list
+            Transformed registers
+
+        Returns
+        -------
+        linked : list
+            Linked registers in the same order
+        '''
+        self.prefetch_entities(registers)
+        linked=[]
+        for register in registers:
+            entry={}
+            entry["author_institutions"]=[]
+            entry["document"]=register["document"]
+            for author in register["author_institutions"]:
+                entry["author_institutions"].append(self.link_authors_institutions(author))
+            entry["source"]=self.link_source(register["source"])
+            linked.append(entry)
+        return linked
+
+    def parallel_link(self,batch_size=100):
+        batches=[self.transformed[i:i+batch_size] for i in range(0,len(self.transformed),batch_size)]
+        result=Parallel(n_jobs=self.n_jobs,backend="threading",verbose=10)(delayed(self.link_batch)(batch) for batch in batches)
+        self.transformed=[reg for batch in result for reg in batch]
 
-    def load(self):
+    def load(self,bulk=False):
         '''
         Loads the new registers to the databse and modify them if needed.
+
+        Parameters
+        ----------
+        bulk : bool
+            If True the writes are sent with unordered bulk writes in batches of bulk_size. Default False
         '''
         for paper in self.transformed:
-            self.insert_one(paper)
+            if bulk:
+                self.insert_bulk(paper)
+            else:
+                self.insert_one(paper)
+        if bulk:
+            self.flush()
 
-    def process_one(self,index):
+    def process_one(self,index,bulk=False):
         data=self.find_one_doi(self.articles[index])
         parsed=self.transform_one(data)
         del(data)
         linked=self.link_one(parsed)
         del(parsed)
+        if bulk:
+            return self.insert_bulk(linked)
         return self.insert_one(linked)
 
-    def parallel_all_from_collection(self,db,collection,field):
+    def parallel_all_from_collection(self,db,collection,field,bulk=False,journal=None):
+        if journal:
+            #resumable run through the streaming pipeline
+            self.status=self.stream_from_collection(db,collection,field,n_link=self.n_jobs,n_load=self.n_jobs,bulk=bulk,journal=journal)
+            return
         self.articles=self.get_doilist_from_collection(db,collection,field)
-        result=Parallel(n_jobs=self.n_jobs,backend="threading",verbose=10)(delayed(self.process_one)(i) for i in range(len(self.articles)))
+        result=Parallel(n_jobs=self.n_jobs,backend="threading",verbose=10)(delayed(self.process_one)(i,bulk) for i in range(len(self.articles)))
+        if bulk:
+            self.flush()
         self.status=result
 
-    def parallel_all_from_doilist(self,doilist):
+    def parallel_all_from_doilist(self,doilist,bulk=False):
         self.articles=doilist
-        result=Parallel(n_jobs=self.n_jobs,backend="threading",verbose=10)(delayed(self.process_one)(i) for i in range(len(self.articles)))
+        result=Parallel(n_jobs=self.n_jobs,backend="threading",verbose=10)(delayed(self.process_one)(i,bulk) for i in range(len(self.articles)))
+        if bulk:
+            self.flush()
         self.status=result
 
+    def stream(self,dois,batch_size=100,queue_size=4,n_transform=1,n_link=1,n_load=1,transform_processes=True,bulk=False,journal=None):
+        '''
+        Runs the extract, transform, link and load steps as a streaming pipeline over an iterable of DOIs
+        (a list, a generator or a mongo cursor), without keeping the whole data in memory.
+        The DOIs are processed in batches and each step runs in its own workers, connected to the next one
+        by a bounded queue, so at most queue_size batches wait between two steps.
+        The CPU-bound transform step runs in a process pool while the I/O-bound steps
+        (extract, link and load) run in threads, so the parsing scales with the cores and overlaps with the database work.
+
+        Parameters
+        ----------
+        dois : iterable
+            DOIs to process
+        batch_size : int
+            Number of DOIs in each batch. Default 100
+        queue_size : int
+            Maximum number of batches waiting between two steps. Default 4
+        n_transform : int
+            Number of processes (or threads) transforming batches. Default 1
+        n_link : int
+            Number of threads linking batches. Default 1
+        n_load : int
+            Number of threads loading batches. Default 1
+        transform_processes : bool
+            If True the transform step runs in processes, otherwise in threads. Default True
+        bulk : bool
+            If True the writes are sent with unordered bulk writes in batches of bulk_size. Default False
+        journal : str
+            Name of the run in the progress journal. If a run with this name was interrupted,
+            the DOIs before its last committed batch are skipped. The dois must come in the same order. Default None
+
+        Returns
+        -------
+        Generator with the id of each loaded document
+        '''
+        run=RunJournal(self.db,journal) if journal else None
+        return self.stream_keyed(enumerate(dois),batch_size=batch_size,queue_size=queue_size,n_transform=n_transform,n_link=n_link,n_load=n_load,transform_processes=transform_processes,bulk=bulk,journal=run)
+
+    def stream_keyed(self,items,batch_size=100,queue_size=4,n_transform=1,n_link=1,n_load=1,transform_processes=True,bulk=False,journal=None):
+        '''
+        Streaming pipeline over an iterable of (key, doi) tuples, where the keys grow with the input order (see stream).
+        The keys are recorded in the journal when the batches are loaded.
+
+        Parameters
+        ----------
+        items : iterable
+            Tuples (key, doi)
+        journal : RunJournal
+            Progress journal of the run. Default None
+
+        Yields
+        ------
+        document_id : ObjectId
+            Id of each loaded document
+        '''
+        if journal:
+            boundary=journal.boundary
+            processed=journal.processed_keys()
+            items=((key,doi) for key,doi in items if (boundary is None or key>boundary) and not key in processed)
+
+        def batches():
+            for batch in batched(items,batch_size):
+                number=journal.add_batch([key for key,doi in batch]) if journal else None
+                yield number,[doi for key,doi in batch]
+
+        executor=transform_pool(n_transform) if transform_processes else None
+
+        def extract(batch):
+            number,dois=batch
+            return number,self.find_dois(dois)
+
+        def transform(batch):
+            number,registers=batch
+            if executor:
+                return number,executor.submit(transform_batch,registers).result()
+            return number,[self.transform_one(register) for register in registers]
+
+        def link(batch):
+            number,registers=batch
+            return number,self.link_batch(registers)
+
+        def load(batch):
+            number,registers=batch
+            if bulk:
+                ids=[self.insert_bulk(register) for register in registers]
+                if journal:
+                    self.flush()
+            else:
+                ids=[self.insert_one(register).inserted_id for register in registers]
+            if journal:
+                journal.commit_batch(number)
+            return ids
+
+        pipeline=Pipeline([
+            ("extract",extract,1),
+            ("transform",transform,n_transform),
+            ("link",link,n_link),
+            ("load",load,n_load)
+        ],queue_size=queue_size)
+        results=pipeline.run(batches())
+        try:
+            for ids in results:
+                for document_id in ids:
+                    yield document_id
+            if journal:
+                journal.finish()
+        finally:
+            #stops the stages if the consumer did not read all the documents
+            results.close()
+            if executor:
+                executor.shutdown()
+            if bulk:
+                self.flush()
+
+    def stream_from_collection(self,db,collection,field,batch_size=100,queue_size=4,n_transform=1,n_link=1,n_load=1,transform_processes=True,bulk=False,journal=None):
+        '''
+        Streams the DOIs of a collection that are not loaded yet through the ETL pipeline (see stream).
+        With a journal, an interrupted run is resumed reading only the registers after the last committed batch.
+
+        Parameters
+        ----------
+        db : str
+            Name of the mongodb database
+        collection : str
+            Name of the collection inside db which contains the data
+        field : str
+            Name of the field with the DOI
+        journal : str
+            Name of the run in the progress journal. Default None
+
+        Returns
+        -------
+        count : int
+            Number of loaded documents
+        '''
+        run=RunJournal(self.db,journal) if journal else None
+        items=self.iter_doi_ids_from_collection(db,collection,field,start_id=run.boundary if run else None)
+        count=0
+        for document_id in self.stream_keyed(items,batch_size=batch_size,queue_size=queue_size,n_transform=n_transform,n_link=n_link,n_load=n_load,transform_processes=transform_processes,bulk=bulk,journal=run):
+            count+=1
+            if self.verbose>0 and count%1000==0:
+                print("{} documents loaded".format(count))
+        return count
+
+    def incremental(self,dbs=["lens","wos","scopus","scholar","oadoi"],field="_id",batch_size=100,n_transform=1):
+        '''
+        Processes only the raw registers with DOI added (or modified) since the last incremental run.
+        Each raw database has a high-water mark, the greatest _id (or ingest timestamp field) processed,
+        and only the registers after it are read. The documents already loaded are merged with the new information
+        and the sources, institutions and authors are modified as usual, so the cost is proportional to the new data.
+        The mark is saved after each batch, so an interrupted run continues from the last batch.
+
+        Parameters
+        ----------
+        dbs : list
+            Raw databases to check. Default all of them
+        field : str
+            Field used as high-water mark, _id or an ingest timestamp. Default _id
+        batch_size : int
+            Number of raw registers processed in each batch. Default 100
+        n_transform : int
+            Number of processes transforming the registers. Default 1
+
+        Returns
+        -------
+        count : int
+            Number of documents inserted or merged
+        '''
+        count=0
+        executor=transform_pool(n_transform) if n_transform>1 else None
+        try:
+            for db in dbs:
+                start=self.get_watermark(db,field)
+                processed=0
+                for batch in batched(self.iter_new_raw_dois(db,field,start),batch_size):
+                    dois=[doi for value,doi in batch if doi]
+                    registers=self.find_dois(dois,include_loaded=True) if dois else []
+                    if executor:
+                        size=max(1,len(registers)//n_transform+1)
+                        transformed=[reg for part in executor.map(transform_batch,batched(registers,size)) for reg in part]
+                    else:
+                        transformed=[self.transform_one(register) for register in registers]
+                    for register in self.link_batch(transformed):
+                        self.insert_one(register,merge=True)
+                    self.set_watermark(db,batch[-1][0],field)
+                    processed+=len(batch)
+                    count+=len(registers)
+                if self.verbose>0:
+                    print("{} new registers processed from {}".format(processed,db+self.db_suffix))
+        finally:
+            if executor:
+                executor.shutdown()
+        return count
+
+    def process_micro_batch(self,batch):
+        '''
+        Transforms, links and loads (merging the documents already loaded) a batch of raw registers
+        and moves forward the high-water mark of their raw databases
+
+        Parameters
+        ----------
+        batch : list
+            Tuples (raw database, _id, doi)
+
+        Returns
+        -------
+        count : int
+            Number of documents inserted or merged
+        '''
+        dois=[doi for db,idx,doi in batch if doi]
+        registers=self.find_dois(dois,include_loaded=True) if dois else []
+        transformed=[self.transform_one(register) for register in registers]
+        for register in self.link_batch(transformed):
+            self.insert_one(register,merge=True)
+        last={}
+        for db,idx,doi in batch:
+            if not db in last.keys() or idx>last[db]:
+                last[db]=idx
+        for db,idx in last.items():
+            current=self.get_watermark(db)
+            if current is None or idx>current:
+                self.set_watermark(db,idx)
+        return len(registers)
+
+    def try_micro_batch(self,batch):
+        '''
+        Processes a micro-batch as process_micro_batch does, but a failed batch is reported and skipped,
+        so the daemon keeps running. The high-water marks are not moved by the failed batch.
+        '''
+        try:
+            return self.process_micro_batch(batch)
+        except Exception as e:
+            print("Could not process a micro-batch of {} registers".format(len(batch)))
+            print(e)
+            return 0
+
+    def watch(self,dbs=["lens","wos","scopus","scholar","oadoi"],batch_size=100,max_latency=5,use_change_streams=True,poll_interval=10):
+        '''
+        Runs Kahi as a daemon that follows the stage collections of the raw databases
+        (with change streams or polling if they are not available) and processes the new or modified registers
+        in micro-batches. A batch is processed when it has batch_size registers or when
+        its first register has waited max_latency seconds. Stops with stop_watch or Ctrl-C.
+
+        Parameters
+        ----------
+        dbs : list
+            Raw databases to follow. Default all of them
+        batch_size : int
+            Maximum number of registers in a micro-batch. Default 100
+        max_latency : float
+            Maximum seconds a register waits before its batch is processed. Default 5
+        use_change_streams : bool
+            If False the collections are always polled. Default True
+        poll_interval : float
+            Seconds between polls of the collections. Default 10
+
+        Returns
+        -------
+        count : int
+            Number of documents inserted or merged
+        '''
+        self.watch_stop.clear()
+        queue=Queue(maxsize=10*batch_size)
+        watchers=[RawWatcher(self,db,queue,self.watch_stop,use_change_streams=use_change_streams,poll_interval=poll_interval) for db in dbs]
+        for watcher in watchers:
+            watcher.start()
+        count=0
+        batch=[]
+        deadline=None
+        clean=False #the pending batch is only processed when the loop is stopped, not when it fails
+        try:
+            while not self.watch_stop.is_set():
+                timeout=1 if deadline is None else max(0,deadline-time())
+                try:
+                    batch.append(queue.get(timeout=timeout))
+                    if deadline is None:
+                        deadline=time()+max_latency
+                except Empty:
+                    pass
+                if batch and (len(batch)>=batch_size or time()>=deadline):
+                    count+=self.try_micro_batch(batch)
+                    if self.verbose>0:
+                        print("{} registers processed, {} documents loaded since the start".format(len(batch),count))
+                    batch=[]
+                    deadline=None
+            clean=True
+        except KeyboardInterrupt:
+            print("Stopping Kahi watch")
+            clean=True
+        finally:
+            self.watch_stop.set()
+            if clean and batch:
+                count+=self.try_micro_batch(batch)
+            for watcher in watchers:
+                watcher.join(poll_interval)
+        return count
+
+    def stop_watch(self):
+        '''
+        Finishes the watch loop after the current micro-batch
+        '''
+        self.watch_stop.set()
+
     def process_one_data(self,index):
         raw=self.data_articles[index]
         indexes,data=self.find_one_similarity(raw)
@@ -192,12 +548,9 @@ class Kahi(KahiDb):
             if value or value==0:
                 #Adding the checkpoint data to the register
                 linked["document"]["source_checked"].append({"source":key+self.db_suffix,"id":self.mongo_ids[key][value]})
-                #removing the processed information from similarity lists
-                self.mongo_ids[key].pop(value)
-                self.titles[key].pop(value)
-                self.sources[key].pop(value)
-                self.years[key].pop(value)
-                print("Now the similarity list for {} has {} elements".format(key,len(self.mongo_ids[key])))
+                #removing the processed information from similarity search
+                self.remove_similarity(key,value)
+                print("Now the similarity list for {} has {} elements".format(key,self.similarity_pool.size(key)))
         del(parsed)
         return self.insert_one(linked)
 
@@ -205,11 +558,14 @@ class Kahi(KahiDb):
         for i in range(len(self.data_articles)):
             process_one_data(i)
         
-    def process_data_from_db(self,db,collection="stage",doi_field="doi_idx"):
-        #get the register from the collection
-        full_data,self.data_articles=self.find_data_through_database(db,collection,doi_field)
+    def process_data_from_db(self,db,collection="stage",doi_field="doi_idx",journal=None):
+        run=RunJournal(self.db,journal) if journal else None
+        #get the register from the collection, after the last processed one if the run is resumed
+        full_data,self.data_articles=self.find_data_through_database(db,collection,doi_field,start_id=run.boundary if run else None)
         #get the rest of the entitites from the similarity check not including the db
         for index,raw in enumerate(self.data_articles):
+            if run:
+                number=run.add_batch([full_data[index]["_id"]])
             indexes,data=self.find_one_similarity(raw,exclude=[db])
             self.found_ids.append(indexes)
             #add the register from the actual db
@@ -222,13 +578,14 @@ class Kahi(KahiDb):
                 if value or value==0:
                     #Adding the checkpoint data to the register
                     linked["document"]["source_checked"].append({"source":key+self.db_suffix,"id":self.mongo_ids[key][value]})
-                    #removing the processed information from similarity lists
-                    self.mongo_ids[key].pop(value)
-                    self.titles[key].pop(value)
-                    self.sources[key].pop(value)
-                    self.years[key].pop(value)
-                    print("Now the similarity list for {} has {} elements".format(key,len(self.mongo_ids[key])))
+                    #removing the processed information from similarity search
+                    self.remove_similarity(key,value)
+                    print("Now the similarity list for {} has {} elements".format(key,self.similarity_pool.size(key)))
             self.insert_one(linked)
+            if run:
+                run.commit_batch(number)
+        if run:
+            run.finish()
 
 
 
@@ -0,0 +1,133 @@
+from collections import OrderedDict
+from copy import deepcopy
+from threading import Lock
+
+#Fields used to look up each collection while linking
+lookup_fields={
+    "authors":["external_ids.value","aliases"],
+    "institutions":["external_ids.value"],
+    "sources":["serials.value"]
+}
+
+def field_values(entity,field):
+    '''
+    Values of a dotted field (like external_ids.value) in an entity, following lists as mongodb does
+    '''
+    values=[entity]
+    for key in field.split("."):
+        found=[]
+        for value in values:
+            if isinstance(value,list):
+                for item in value:
+                    if isinstance(item,dict) and key in item.keys():
+                        found.append(item[key])
+            elif isinstance(value,dict) and key in value.keys():
+                found.append(value[key])
+        values=found
+    result=[]
+    for value in values:
+        if isinstance(value,list):
+            result.extend(value)
+        else:
+            result.append(value)
+    return [value for value in result if value or value==0]
+
+class EntityCache():
+    def __init__(self,max_size=100000):
+        '''
+        Bounded, thread-safe identity cache for the authors, institutions and sources
+        looked up while linking. The keys are (collection, lookup field, value) and point to
+        the id of the entity, the entities are stored once by (collection, id).
+        Misses are also cached, and they are overwritten as soon as an entity with that key is put,
+        so the entities inserted by one thread are found right away by the others.
+
+        Parameters
+        ----------
+        max_size : int
+            Maximum number of keys and of entities kept in memory. Default 100000
+        '''
+        self.max_size=max_size
+        self.keys=OrderedDict()
+        self.entities=OrderedDict()
+        self.lock=Lock()
+
+    def trim(self,store):
+        while len(store)>self.max_size:
+            store.popitem(last=False)
+
+    def get(self,collection,field,value):
+        '''
+        Looks for an entity in the cache
+
+        Returns
+        -------
+        found : bool
+            True if the key is in the cache, even if it was cached as a miss
+        entity : dict
+            Copy of the entity or None if it does not exist in the database
+        '''
+        key=(collection,field,value)
+        with self.lock:
+            if not key in self.keys.keys():
+                return False,None
+            self.keys.move_to_end(key)
+            idx=self.keys[key]
+            if idx is None:
+                return True,None
+            if not (collection,idx) in self.entities.keys():
+                del(self.keys[key])
+                return False,None
+            self.entities.move_to_end((collection,idx))
+            return True,deepcopy(self.entities[(collection,idx)])
+
+    def put_missing(self,collection,field,value):
+        '''
+        Caches that there is not entity for the key, unless an entity was put meanwhile
+        '''
+        key=(collection,field,value)
+        with self.lock:
+            if not key in self.keys.keys():
+                self.keys[key]=None
+                self.trim(self.keys)
+
+    def register(self,collection,entity):
+        for field in lookup_fields.get(collection,[]):
+            for value in field_values(entity,field):
+                try:
+                    key=(collection,field,value)
+                    self.keys[key]=entity["_id"]
+                    self.keys.move_to_end(key)
+                except TypeError: #unhashable values are not cached
+                    pass
+        self.trim(self.keys)
+
+    def put(self,collection,entity):
+        '''
+        Stores a copy of an entity (it must have the _id) under all its lookup keys
+        '''
+        if not "_id" in entity.keys():
+            return
+        entity=deepcopy(entity)
+        with self.lock:
+            self.entities[(collection,entity["_id"])]=entity
+            self.entities.move_to_end((collection,entity["_id"]))
+            self.trim(self.entities)
+            self.register(collection,entity)
+
+    def update(self,collection,idx,mod):
+        '''
+        Applies a $set modification to a cached entity and registers its new lookup keys.
+        If the entity is not cached nothing is done, it will be read from the database when needed.
+        '''
+        with self.lock:
+            if not (collection,idx) in self.entities.keys():
+                return
+            entity=self.entities[(collection,idx)]
+            for key,value in mod.items():
+                entity[key]=deepcopy(value)
+            self.register(collection,entity)
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+            self.entities.clear()
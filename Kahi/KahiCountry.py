@@ -0,0 +1,237 @@
+import re
+from collections import OrderedDict
+from threading import Lock
+import iso3166
+from unidecode import unidecode
+
+#Spellings used by the raw databases (WoS, Scopus, Scielo and Lens) that are not ISO 3166 names
+country_aliases={
+    "ENGLAND":"GB",
+    "SCOTLAND":"GB",
+    "WALES":"GB",
+    "NORTH IRELAND":"GB",
+    "NORTHERN IRELAND":"GB",
+    "UNITED KINGDOM":"GB",
+    "UK":"GB",
+    "UNITED STATES":"US",
+    "USA":"US",
+    "CZECH REPUBLIC":"CZ",
+    "VENEZUELA":"VE",
+    "VIETNAM":"VN",
+    "RUSSIA":"RU",
+    "PEOPLES R CHINA":"CN",
+    "IRAN":"IR",
+    "SOUTH KOREA":"KR",
+    "NORTH KOREA":"KP",
+    "U ARAB EMIRATES":"AE",
+    "UNITED ARAB EMIRATES":"AE",
+    "DEM REP CONGO":"CD",
+    "REP CONGO":"CG",
+    "TANZANIA":"TZ",
+    "TAIWAN":"TW",
+    "MICRONESIA":"FM",
+    "BOLIVIA":"BO",
+    "REUNION":"RE",
+    "TURKEY":"TR",
+    "SYRIA":"SY",
+    "LAOS":"LA",
+    "MOLDOVA":"MD",
+    "MACEDONIA":"MK",
+    "BRUNEI":"BN",
+    "CAPE VERDE":"CV",
+    "COTE IVOIRE":"CI",
+    "IVORY COAST":"CI",
+    "PAPUA N GUINEA":"PG",
+    "BOSNIA & HERCEG":"BA",
+    "BOSNIA AND HERZEGOVINA":"BA",
+    "TRINID & TOBAGO":"TT",
+    "TRINIDAD AND TOBAGO":"TT",
+    "DOMINICAN REP":"DO",
+    "CENT AFR REPUBL":"CF",
+    "GUINEA BISSAU":"GW",
+    "ST KITTS & NEVI":"KN",
+    "ST LUCIA":"LC",
+    "ST VINCENT":"VC",
+    "ANTIGUA & BARBU":"AG",
+    "TURKS & CAICOS":"TC",
+    "FALKLAND ISLAND":"FK",
+    "SAO TOME & PRIN":"ST",
+    "VATICAN":"VA",
+    "PALESTINE":"PS"
+}
+
+def normalize_country(name):
+    '''
+    Normalizes a country name to be used as key: uppercase, without accents, dots or repeated spaces
+    '''
+    return " ".join(unidecode(str(name)).upper().replace(".","").split())
+
+def build_country_index():
+    '''
+    Builds the dictionary from normalized country names to alpha2 codes with
+    the ISO 3166 names, the apolitical names, the short names (before the comma, as "BOLIVIA"
+    for "BOLIVIA, PLURINATIONAL STATE OF") when they are not ambiguous, and the aliases of the raw databases
+    '''
+    index={}
+    short={}
+    for country in iso3166.countries:
+        for name in [country.name,country.apolitical_name]:
+            index[normalize_country(name)]=country.alpha2
+            if "," in name:
+                key=normalize_country(name.split(",")[0])
+                short.setdefault(key,set()).add(country.alpha2)
+    for key,codes in short.items():
+        if len(codes)==1 and not key in index.keys():
+            index[key]=codes.pop()
+    for name,code in country_aliases.items():
+        index[normalize_country(name)]=code
+    return index
+
+class CountryResolver():
+    def __init__(self,max_misses=100000):
+        '''
+        Resolves country names to ISO 3166 alpha2 codes with a precomputed dictionary,
+        so each lookup is a single dict access instead of a chain of comparisons.
+        The names not found are kept in a bounded negative cache.
+
+        Parameters
+        ----------
+        max_misses : int
+            Maximum number of names kept in the negative cache. Default 100000
+        '''
+        self.index=build_country_index()
+        self.max_misses=max_misses
+        self.misses=OrderedDict()
+        self.lock=Lock()
+
+    def resolve(self,name,usa_suffix=False):
+        '''
+        Finds the alpha2 code of a country name
+
+        Parameters
+        ----------
+        name : str
+            Name of the country as given by a raw register
+        usa_suffix : bool
+            If True, names ending in USA (like "CA 94305 USA" in WoS addresses) are resolved to US. Default False
+
+        Returns
+        -------
+        country_code : str
+            Uppercase alpha2 country code, empty if the name could not be resolved
+        '''
+        if not name:
+            return ""
+        key=normalize_country(name)
+        code=self.index.get(key)
+        if code:
+            return code
+        if usa_suffix and key[-3:]=="USA":
+            return "US"
+        with self.lock:
+            if key in self.misses.keys():
+                self.misses.move_to_end(key)
+                return ""
+        code=self.fallback(key)
+        with self.lock:
+            if code:
+                self.index[key]=code
+            else:
+                self.misses[key]=True
+                while len(self.misses)>self.max_misses:
+                    self.misses.popitem(last=False)
+        return code
+
+    def fallback(self,key):
+        '''
+        Slower checks for the names not in the dictionary: ISO codes (alpha3 or numeric)
+        and names with a leading "THE" or with text between parentheses
+        '''
+        if len(key)==3 or key.isdigit(): #two letters codes are left out, they are usually states or provinces
+            try:
+                return iso3166.countries.get(key).alpha2
+            except (KeyError,ValueError,TypeError):
+                pass
+        stripped=re.sub(r"\(.*?\)","",key)
+        if stripped.startswith("THE "):
+            stripped=stripped[4:]
+        stripped=" ".join(stripped.split())
+        return self.index.get(stripped,"")
+
+class CountryMatcher():
+    def __init__(self,index):
+        '''
+        Precompiled matcher of country names in free text, as affiliation strings.
+        The names of the index are stored in a trie of words, so all the country mentions are found
+        in a single pass, and as GeoText only a whole capitalized phrase is taken as a mention (see find).
+
+        Parameters
+        ----------
+        index : dict
+            Normalized country names as keys and alpha2 codes as values (see build_country_index)
+        '''
+        self.trie={}
+        for name,code in index.items():
+            node=self.trie
+            for word in re.findall(r"[^\W_]+",name):
+                node=node.setdefault(word,{})
+            node[None]=code #end of a name
+
+    def capitalized(self,text,words,i,j):
+        '''
+        Checks if the words i and j are capitalized and in the same phrase (only separated by spaces or hyphens)
+        '''
+        if i<0 or j>=len(words):
+            return False
+        if not text[words[j][0]].isupper():
+            return False
+        return text[words[i][1]:words[j][0]].strip(" -")==""
+
+    def find(self,text):
+        '''
+        Finds the country mentions in a text. As GeoText, a mention must be a whole capitalized phrase,
+        so names as "New Mexico", "New Jersey" or "Mexico City" are not taken as countries.
+
+        Returns
+        -------
+        spans : list
+            Tuples (start, end, alpha2 code) with the positions of the mentions in the text, in order
+        '''
+        words=[(match.start(),match.end(),normalize_country(match.group())) for match in re.finditer(r"[^\W_]+",text)]
+        spans=[]
+        i=0
+        while i<len(words):
+            found=None
+            if text[words[i][0]].isupper() and not self.capitalized(text,words,i-1,i):
+                node=self.trie
+                j=i
+                while j<len(words) and words[j][2] in node.keys():
+                    node=node[words[j][2]]
+                    j+=1
+                    if None in node.keys():
+                        found=(j,node[None])
+            if found and self.capitalized(text,words,found[0]-1,found[0]):
+                found=None #the country name is only part of a longer capitalized phrase
+            if found:
+                j,code=found
+                spans.append((words[i][0],words[j-1][1],code))
+                i=j
+            else:
+                i+=1
+        return spans
+
+#Resolver and matcher shared by all the parsers of the process
+country_resolver=CountryResolver()
+country_matcher=CountryMatcher(country_resolver.index)
+
+def resolve_country(name,usa_suffix=False):
+    '''
+    Alpha2 code of a country name with the shared resolver (see CountryResolver.resolve)
+    '''
+    return country_resolver.resolve(name,usa_suffix=usa_suffix)
+
+def find_countries(text):
+    '''
+    Country mentions in a text with the shared matcher (see CountryMatcher.find)
+    '''
+    return country_matcher.find(text)
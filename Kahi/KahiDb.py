@@ -10,16 +10,16 @@ import requests
 from pandas import read_csv
 from joblib import Parallel, delayed
 from bson.objectid import ObjectId
+from threading import Lock
 
 from Kahi.KahiParser import KahiParser
+from Kahi.KahiSimilarity import SimilarityPool, parse_string
+from Kahi.KahiRor import RorResolver, RorDumpResolver
+from Kahi.KahiLoader import BulkLoader
+from Kahi.KahiCache import EntityCache
 
 # START HELPER FUNCTION SECCTION
 
-def parse_string(text):
-    text = unidecode(text.lower())
-    text = re.sub( r'[\$_\^]','', re.sub(r'\\\w+','',text ))
-    return str(text)
-
 def __colav_similarity(title1,title2,journal1,journal2,year1,year2, ratio_thold=90, partial_thold=95,low_thold=80,verbose=0):
 
     label = False
@@ -108,8 +108,20 @@ def evaluate_similarity(data,title,source,year,ratio=90,partial=95,low=80):
         return pred
         #return True
 
+def has_collscan(plan):
+    '''
+    Checks if a query plan from explain (or any of its inner stages) is a collection scan
+    '''
+    if isinstance(plan,dict):
+        if plan.get("stage")=="COLLSCAN":
+            return True
+        return any(has_collscan(value) for key,value in plan.items() if key!="rejectedPlans")
+    if isinstance(plan,list):
+        return any(has_collscan(value) for value in plan)
+    return False
+
 class KahiDb(KahiParser):
-    def __init__(self,dbserver_url="localhost",port=27017,colav_db="colav",db_suffix="_antioquia",ror_url='https://api.ror.org/organizations?affiliation=',n_jobs=24,verbose=5):
+    def __init__(self,dbserver_url="localhost",port=27017,colav_db="colav",db_suffix="_antioquia",ror_url='https://api.ror.org/organizations?affiliation=',ror_cache_file=None,ror_concurrency=10,ror_timeout=30,ror_dump=None,bulk_size=1000,entity_cache_size=100000,n_jobs=24,verbose=5):
         """
         Base class for Kahi. Includes methods to retrieve, compare, insert and update
         authors, institutions, documents and sources
@@ -129,6 +141,28 @@ class KahiDb(KahiParser):
         colav_db : str
             Name of the colav database. Default colav
 
+        ror_url : str
+            Url of the ROR affiliation endpoint (local or remote)
+
+        ror_cache_file : str
+            Path to a sqlite file where the ROR responses are cached across runs. Default None (only in memory)
+
+        ror_concurrency : int
+            Maximum number of simultaneous requests to the ROR service. Default 10
+
+        ror_timeout : float
+            Seconds to wait for the ROR service to respond. Default 30
+
+        ror_dump : str
+            Path to a ROR data dump (json or zip). If given, the affiliations are resolved offline
+            with an index of the dump instead of the ROR service. Default None
+
+        bulk_size : int
+            Number of queued writes that triggers a flush when loading with insert_bulk. Default 1000
+
+        entity_cache_size : int
+            Maximum number of authors, institutions and sources lookups kept in memory while linking. Default 100000
+
         verbose : int
             Level of developer messages. 0 is no messages and 5 is anoying
 
@@ -142,10 +176,18 @@ class KahiDb(KahiParser):
         super().__init__(verbose=verbose)
 
         self.ror_url=ror_url
+        if ror_dump:
+            self.ror=RorDumpResolver(ror_dump)
+        else:
+            self.ror=RorResolver(ror_url=ror_url,cache_file=ror_cache_file,concurrency=ror_concurrency,timeout=ror_timeout)
         self.client=MongoClient(dbserver_url,port)
         self.db=self.client[colav_db]
 
         self.n_jobs=n_jobs
+
+        #Authors, institutions and sources already seen while linking, shared by all the threads
+        self.entity_cache=EntityCache(entity_cache_size)
+        self.loader=BulkLoader(self.db,batch_size=bulk_size,cache=self.entity_cache)
         
         self.db_suffix=db_suffix
         self.collection="stage"
@@ -157,93 +199,202 @@ class KahiDb(KahiParser):
         self.scholardb=self.client["scholar"+self.db_suffix]
         self.oadoidb=self.client["oadoi"+self.db_suffix]
         self.doajdb=self.client["doaj"]
+        self.raw_dbs={"lens":self.lensdb,"wos":self.wosdb,"scopus":self.scopusdb,"scholar":self.scholardb,"oadoi":self.oadoidb}
 
         #We have to load in memory all the information needed for the similarity checks
         #Namely: mongo ids, titles, years and sources
         #They have to be dicts since we have to do the similarity check for each raw database
         # but just save the ones that don't have DOI
+        #The lists of each raw database are loaded the first time the similarity search needs them
+        #or all at once calling preload
         self.mongo_ids={"lens":[],"wos":[],"scielo":[],"scopus":[],"scholar":[]}
         self.titles={"lens":[],"wos":[],"scielo":[],"scopus":[],"scholar":[]}
         self.years={"lens":[],"wos":[],"scielo":[],"scopus":[],"scholar":[]}
         self.sources={"lens":[],"wos":[],"scielo":[],"scopus":[],"scholar":[]}
+        self.similarity_loaded=set()
+        self.similarity_lock=Lock()
 
-        
+        #The similarity lists are sent once to a pool of long-lived workers, each one keeps its shard
+        #with a blocking index, so each query is only compared with the registers
+        #that share the year (+-1) and at least one title token.
+        #The pool is started with the first database loaded
+        self.similarity_pool=None
 
-        for reg in self.lensdb[self.collection].find():
-            doi=""
-            for ext in reg["external_ids"]:
-                if ext["type"]=="doi":
-                    doi=ext["value"]
-                    break
-            if doi:
-                continue
-            if self.db["documents"].find_one({"source_checked.id":ObjectId(reg["_id"])}):
-                continue
-            self.titles["lens"].append(reg["title"])
-            journal=""
-            if "source" in reg.keys():
-                if "title_full" in reg["source"].keys():
-                    journal=reg["source"]["title_full"]
-            self.sources["lens"].append(str(journal))
-            self.years["lens"].append(reg["year_published"])
-            self.mongo_ids["lens"].append(reg["_id"])
-        print("Loaded {} registers from {} database".format(len(self.mongo_ids["lens"]),"lens"+self.db_suffix))
-        
-        for reg in self.wosdb[self.collection].find({"doi_idx":""}):
-            if reg["doi_idx"]:
-                continue
-            if self.db["documents"].find_one({"source_checked.id":ObjectId(reg["_id"])}):
-                continue
-            self.titles["wos"].append(reg["TI"])
-            self.sources["wos"].append(str(reg["SO"]))
-            year=""
-            if reg["PY"]!="":
-                try:
-                    year=int(reg["PY"])
-                except Exception as e:
-                    try:
-                        year=int(reg["PY"][:-1])
-                    except Exception as e:
-                        print(e)
-            self.years["wos"].append(year)
-            self.mongo_ids["wos"].append(reg["_id"])
-        print("Loaded {} registers from {} database".format(len(self.mongo_ids["wos"]),"wos"+self.db_suffix))
-
-        for reg in self.scopusdb[self.collection].find({"doi_idx":""}):
-            if reg["doi_idx"]:
-                continue
-            if self.db["documents"].find_one({"source_checked.id":ObjectId(reg["_id"])}):
-                continue
-            self.titles["scopus"].append(reg["Title"])
-            self.sources["scopus"].append(str(reg["Source title"]))
-            self.years["scopus"].append(reg["Year"])
-            self.mongo_ids["scopus"].append(reg["_id"])
-        print("Loaded {} registers from {} database".format(len(self.mongo_ids["scopus"]),"scopus"+self.db_suffix))
-
-        for reg in self.scholardb[self.collection].find():
-            if "doi_idx" in reg.keys():
-                if reg["doi_idx"]:
-                    continue
-            if self.db["documents"].find_one({"source_checked.id":ObjectId(reg["_id"])}):
-                continue
-            self.titles["scholar"].append(reg["title"])
-            self.sources["scholar"].append(str(reg["journal"]))
-            year=""
-            if reg["year"]!="":
-                try:
-                    year=int(reg["year"])
-                except Exception as e:
-                    try:
-                        year=int(reg["year"][:-1])
-                    except Exception as e:
-                        print(e)
-            self.years["scholar"].append(year)
-            self.mongo_ids["scholar"].append(reg["_id"])
-        print("Loaded {} registers from {} database".format(len(self.mongo_ids["scholar"]),"scholar"+self.db_suffix))
+    #END __init__
 
-        
+    def load_similarity(self,db,checked=None):
+        '''
+        Loads in memory the information needed for the similarity checks of one raw database
+        and sends it to the similarity workers. Only the registers without DOI
+        that have not been processed yet are loaded.
 
-    #END __init__
+        Parameters
+        ----------
+        db : str
+            Name of the raw database (lens, wos, scielo, scopus or scholar)
+        checked : set
+            Ids of the raw registers already processed. If not given, they are fetched from the documents collection
+        '''
+        with self.similarity_lock:
+            if db in self.similarity_loaded:
+                return
+            if checked is None:
+                #Raw registers already processed, fetched all at once instead of one query per register
+                checked=self.get_checked_ids()
+            self.mongo_ids[db]=[]
+            self.titles[db]=[]
+            self.years[db]=[]
+            self.sources[db]=[]
+            if db=="lens":
+                for reg in self.lensdb[self.collection].find({},{"external_ids":1,"title":1,"source.title_full":1,"year_published":1}):
+                    doi=""
+                    for ext in reg["external_ids"]:
+                        if ext["type"]=="doi":
+                            doi=ext["value"]
+                            break
+                    if doi:
+                        continue
+                    if reg["_id"] in checked:
+                        continue
+                    self.titles["lens"].append(reg["title"])
+                    journal=""
+                    if "source" in reg.keys():
+                        if "title_full" in reg["source"].keys():
+                            journal=reg["source"]["title_full"]
+                    self.sources["lens"].append(str(journal))
+                    self.years["lens"].append(reg["year_published"])
+                    self.mongo_ids["lens"].append(reg["_id"])
+                print("Loaded {} registers from {} database".format(len(self.mongo_ids["lens"]),"lens"+self.db_suffix))
+            elif db=="wos":
+                for reg in self.wosdb[self.collection].find({"doi_idx":""},{"doi_idx":1,"TI":1,"SO":1,"PY":1}):
+                    if reg["doi_idx"]:
+                        continue
+                    if reg["_id"] in checked:
+                        continue
+                    self.titles["wos"].append(reg["TI"])
+                    self.sources["wos"].append(str(reg["SO"]))
+                    year=""
+                    if reg["PY"]!="":
+                        try:
+                            year=int(reg["PY"])
+                        except Exception as e:
+                            try:
+                                year=int(reg["PY"][:-1])
+                            except Exception as e:
+                                print(e)
+                    self.years["wos"].append(year)
+                    self.mongo_ids["wos"].append(reg["_id"])
+                print("Loaded {} registers from {} database".format(len(self.mongo_ids["wos"]),"wos"+self.db_suffix))
+            elif db=="scopus":
+                for reg in self.scopusdb[self.collection].find({"doi_idx":""},{"doi_idx":1,"Title":1,"Source title":1,"Year":1}):
+                    if reg["doi_idx"]:
+                        continue
+                    if reg["_id"] in checked:
+                        continue
+                    self.titles["scopus"].append(reg["Title"])
+                    self.sources["scopus"].append(str(reg["Source title"]))
+                    self.years["scopus"].append(reg["Year"])
+                    self.mongo_ids["scopus"].append(reg["_id"])
+                print("Loaded {} registers from {} database".format(len(self.mongo_ids["scopus"]),"scopus"+self.db_suffix))
+            elif db=="scholar":
+                for reg in self.scholardb[self.collection].find({},{"doi_idx":1,"title":1,"journal":1,"year":1}):
+                    if "doi_idx" in reg.keys():
+                        if reg["doi_idx"]:
+                            continue
+                    if reg["_id"] in checked:
+                        continue
+                    self.titles["scholar"].append(reg["title"])
+                    self.sources["scholar"].append(str(reg["journal"]))
+                    year=""
+                    if reg["year"]!="":
+                        try:
+                            year=int(reg["year"])
+                        except Exception as e:
+                            try:
+                                year=int(reg["year"][:-1])
+                            except Exception as e:
+                                print(e)
+                    self.years["scholar"].append(year)
+                    self.mongo_ids["scholar"].append(reg["_id"])
+                print("Loaded {} registers from {} database".format(len(self.mongo_ids["scholar"]),"scholar"+self.db_suffix))
+
+            if self.similarity_pool is None:
+                self.similarity_pool=SimilarityPool(self.n_jobs)
+            self.similarity_pool.load(db,self.titles[db],self.sources[db],self.years[db])
+            self.similarity_loaded.add(db)
+
+    def preload(self):
+        '''
+        Loads the similarity information of all the raw databases at once.
+        Useful to warm up before a similarity based run.
+        '''
+        checked=self.get_checked_ids()
+        for db in self.titles.keys():
+            self.load_similarity(db,checked)
+
+    def get_checked_ids(self):
+        '''
+        Gets the ids of the raw registers already processed, namely
+        the ids in the source_checked field of the documents collection.
+        The collection is streamed with a projection of that field only.
+
+        Returns
+        -------
+        checked : set
+            Set of ObjectIds of the raw registers
+        '''
+        checked=set()
+        for reg in self.db["documents"].find({"source_checked.id":{"$exists":True}},{"source_checked.id":1,"_id":0}):
+            for source in reg["source_checked"]:
+                if "id" in source.keys():
+                    checked.add(ObjectId(source["id"]))
+        return checked
+
+    def index_specs(self):
+        '''
+        Fields used by the queries of Kahi, as tuples (database, collection, field)
+        '''
+        specs=[
+            (self.db,"documents","external_ids.id"),
+            (self.db,"documents","source_checked.id"),
+            (self.db,"authors","external_ids.value"),
+            (self.db,"authors","aliases"),
+            (self.db,"institutions","external_ids.value"),
+            (self.db,"sources","serials.value"),
+            (self.lensdb,self.collection,"external_ids.value"),
+            (self.doajdb,"stage","bibjson.identifier.id")
+        ]
+        for raw_db in [self.wosdb,self.scopusdb,self.scholardb,self.oadoidb]:
+            specs.append((raw_db,self.collection,"doi_idx"))
+        return specs
+
+    def ensure_indexes(self,check=True):
+        '''
+        Creates the indexes the queries of Kahi depend on. Existing indexes are left as they are,
+        so it can be called before every run.
+
+        Parameters
+        ----------
+        check : bool
+            If True each query pattern is explained after creating the indexes
+            and the ones still doing a collection scan are reported. Default True
+
+        Returns
+        -------
+        scans : list
+            Namespaces and fields (database.collection, field) of the queries still doing a collection scan
+        '''
+        for db,collection,field in self.index_specs():
+            if self.verbose>0: print("Ensuring index on {}.{} {}".format(db.name,collection,field))
+            db[collection].create_index([(field,1)])
+        scans=[]
+        if check:
+            for db,collection,field in self.index_specs():
+                plan=db[collection].find({field:""}).explain()
+                if has_collscan(plan.get("queryPlanner",plan)):
+                    scans.append((db.name+"."+collection,field))
+                    print("The query on {}.{} by {} is doing a collection scan".format(db.name,collection,field))
+        return scans
 
     def find_doaj(self,serials):
         doaj=None
@@ -258,6 +409,7 @@ class KahiDb(KahiParser):
         '''
         Finds the institution through a keyword or name by makig a request to the given URL
         which is the GRID.ac API (local or remote).
+        The responses are cached by normalized name, so the service is only requested for new names.
 
         Parameters
         ----------
@@ -270,23 +422,48 @@ class KahiDb(KahiParser):
             GRID.ac result dictionary with the number of results and the full information of them
 
         '''
-        if not token:
-            result={}
-            result["number_of_results"]=0
-            return result
-        query=urllib.parse.quote(token)
-        url='{}{}'.format(self.ror_url,query)
-        res=requests.get(url)
-        if res.status_code!=200:
-            raise NameError("Server responded to the request {} with status error: {}".format(query,res.status_code))
-        result={}
-        try:
-            result=res.json()
-        except Exception as e:
-            result["number_of_results"]=0
-            #print("GOT RESULT: ",result, " BY SEARCHING: ",token)
-            #print(e)
-        return result
+        return self.ror.resolve(token)
+
+    def find_grid_institutions(self,tokens):
+        '''
+        Finds several institutions at once, requesting concurrently the names not cached yet.
+
+        Parameters
+        ----------
+        tokens : list of str
+            The key expressions to search within the GRID db
+
+        Returns
+        -------
+        results : dict
+            The key expression as key and the GRID.ac result dictionary as value
+        '''
+        return self.ror.resolve_many(tokens)
+
+    def prefetch_affiliations(self,registers):
+        '''
+        Resolves concurrently the affiliations without external ids of a batch of transformed registers,
+        which are the ones link_authors_institutions has to search by name.
+        The responses are left in the cache for the linking step.
+
+        Parameters
+        ----------
+        registers : list
+            Transformed registers with the author_institutions key
+        '''
+        names=[]
+        for register in registers:
+            for author in register["author_institutions"]:
+                for affiliation in author["affiliations"]:
+                    if affiliation["name"] and not affiliation["external_ids"]:
+                        names.append(affiliation["name"])
+        if names:
+            try:
+                self.find_grid_institutions(names)
+            except Exception as e:
+                #The names not resolved here are requested again while linking
+                print("Could not prefetch affiliations")
+                print(e)
    
     def find_one_doi(self,doi):
         '''
@@ -345,9 +522,61 @@ class KahiDb(KahiParser):
 
         '''
 
-        register_list=Parallel(n_jobs=self.n_jobs,backend="threading",verbose=10)(delayed(self.find_one_doi)(doi) for doi in doi_list)
+        return self.find_dois(doi_list)
+
+    def find_dois(self,doi_list,chunk_size=1000,include_loaded=False):
+        '''
+        Uses a list of DOI to find the accurrences of the documents in the different raw databases.
+        The DOIs are searched in chunks, with one query per raw database and chunk
+        instead of one query per raw database and DOI. The DOIs already in the documents collection are dropped.
 
-        return [reg for reg in register_list if reg]
+        Parameters
+        ----------
+        doi_list : list of str
+        chunk_size : int
+            Number of DOIs searched in each query. Default 1000
+        include_loaded : bool
+            If True the DOIs already in the documents collection are not dropped. Default False
+
+        Returns
+        -------
+        List of dicts with the raw database name as a key and the register found as its value.
+        If the register was not found, the entry is None.
+
+        '''
+        dois=[]
+        seen=set()
+        for doi in doi_list:
+            doi=doi.lower()
+            if not doi in seen:
+                seen.add(doi)
+                dois.append(doi)
+        del(seen)
+
+        register_list=[]
+        for i in range(0,len(dois),chunk_size):
+            chunk=dois[i:i+chunk_size]
+            if not include_loaded:
+                loaded=self.get_loaded_dois(chunk)
+                chunk=[doi for doi in chunk if not doi in loaded]
+            if not chunk:
+                continue
+            found={"lens":{},"wos":{},"scopus":{},"scholar":{},"oadoi":{}}
+            chunk_set=set(chunk)
+            for reg in self.lensdb[self.collection].find({"external_ids.value":{"$in":chunk}}):
+                for ext in reg["external_ids"]:
+                    if ext["value"] in chunk_set and not ext["value"] in found["lens"].keys():
+                        found["lens"][ext["value"]]=reg
+            for db,raw_db in [("wos",self.wosdb),("scopus",self.scopusdb),("scholar",self.scholardb),("oadoi",self.oadoidb)]:
+                for reg in raw_db[self.collection].find({"doi_idx":{"$in":chunk}}):
+                    if not reg["doi_idx"] in found[db].keys():
+                        found[db][reg["doi_idx"]]=reg
+            for doi in chunk:
+                entry={"scielo":None}
+                for db in ["lens","wos","scopus","scholar","oadoi"]:
+                    entry[db]=found[db][doi] if doi in found[db].keys() else None
+                register_list.append(entry)
+        return register_list
     
 
     def find_doi_file(self,file,column):
@@ -383,13 +612,35 @@ class KahiDb(KahiParser):
     
     
     def parallel_similarity(self,data,db):
+        if not db in self.similarity_loaded:
+            self.load_similarity(db)
+        return self.similarity_pool.query(db,data["title"],data["source"],data["year"])
 
-        results=Parallel(n_jobs=self.n_jobs,backend="multiprocessing",verbose=0)(delayed(evaluate_similarity)(data,self.titles[db][i],self.sources[db][i],self.years[db][i]) for i in range(len(self.titles[db])))
-        try:
-            idx=results.index(True)
-            return idx
-        except:
-            return None
+    def remove_similarity(self,db,idx):
+        '''
+        Removes a register already processed from the similarity search of the given raw database.
+        The similarity lists are kept untouched so the indexes returned by find_one_similarity remain valid.
+
+        Parameters
+        ----------
+        db : str
+            Name of the raw database (lens, wos, scielo, scopus or scholar)
+        idx : int
+            Index of the register in the similarity lists
+        '''
+        if self.similarity_pool is not None:
+            self.similarity_pool.remove(db,idx)
+
+    def close(self):
+        '''
+        Stops the similarity workers and closes the connection to the database server
+        '''
+        self.flush()
+        if self.similarity_pool is not None:
+            self.similarity_pool.close()
+            self.similarity_pool=None
+        self.ror.close()
+        self.client.close()
 
     def find_one_similarity(self,data,exclude=[]):
         '''
@@ -470,10 +721,11 @@ class KahiDb(KahiParser):
             register_list.append(find_one_similarity(data))
         return register_list
     
-    def find_data_through_database(self,db,collection="stage",doi_field="doi_idx"):
+    def find_data_through_database(self,db,collection="stage",doi_field="doi_idx",start_id=None):
         similarity_data=[]
         full_data=[]
-        for reg in self.client[db][collection].find():
+        query={} if start_id is None else {"_id":{"$gt":start_id}}
+        for reg in self.client[db][collection].find(query).sort("_id",1):
             if doi_field in reg.keys():
                 if reg[doi_field]:
                     continue
@@ -525,14 +777,234 @@ class KahiDb(KahiParser):
                 register_list.append(self.find_one_similarity(register))
         return register_list
 
-    def get_doilist_from_collection(self,db,collection,field):
-        doilist=[]
-        for reg in self.client[db][collection].find({},{field:1}):
-            regdb=self.db["documents"].find_one({"external_ids.id":reg[field].lower()})
-            if not regdb:
-                doilist.append(reg[field].lower())
-        return doilist
+    def get_loaded_dois(self,doi_list):
+        '''
+        Finds which DOIs of the list are already in the documents collection with one query
+
+        Parameters
+        ----------
+        doi_list : list of str
+            DOIs in lowercase
+
+        Returns
+        -------
+        loaded : set
+            DOIs of the list found in the documents collection
+        '''
+        loaded=set()
+        if not doi_list:
+            return loaded
+        for reg in self.db["documents"].find({"external_ids.id":{"$in":list(doi_list)}},{"external_ids.id":1,"_id":0}):
+            for ext in reg["external_ids"]:
+                if "id" in ext.keys():
+                    loaded.add(ext["id"])
+        return loaded
+
+    def iter_doi_ids_from_collection(self,db,collection,field,start_id=None,chunk_size=1000):
+        '''
+        Yields the _id and the DOI of the registers of a collection that are not in the documents collection yet,
+        sorted by _id. The collection is read in pages of chunk_size registers and the DOIs of each page
+        are checked with one query, so only one page is kept in memory.
+
+        Parameters
+        ----------
+        db : str
+            Name of the mongodb database
+        collection : str
+            Name of the collection inside db which contains the data
+        field : str
+            Name of the field with the DOI
+        start_id : ObjectId
+            Only the registers with _id greater than start_id are read. Default None (all the collection)
+        chunk_size : int
+            Number of registers read and DOIs checked in each query. Default 1000
+
+        Yields
+        ------
+        (_id, doi) : tuple
+            Id of the register and DOI in lowercase
+        '''
+        #the collection is read in pages by _id, a cursor open during the whole run could expire on the server
+        last=start_id
+        while True:
+            query={} if last is None else {"_id":{"$gt":last}}
+            page=list(self.client[db][collection].find(query,{field:1}).sort("_id",1).limit(chunk_size))
+            if not page:
+                break
+            last=page[-1]["_id"]
+            chunk=[(reg["_id"],reg[field].lower()) for reg in page]
+            loaded=self.get_loaded_dois([doi for idx,doi in chunk])
+            for idx,doi in chunk:
+                if not doi in loaded:
+                    yield idx,doi
+
+    def iter_doilist_from_collection(self,db,collection,field,chunk_size=1000):
+        '''
+        Yields the DOIs of a collection that are not in the documents collection yet (see iter_doi_ids_from_collection)
+
+        Yields
+        ------
+        doi : str
+            DOI in lowercase
+        '''
+        for idx,doi in self.iter_doi_ids_from_collection(db,collection,field,chunk_size=chunk_size):
+            yield doi
+
+    def get_doilist_from_collection(self,db,collection,field,chunk_size=1000):
+        '''
+        Gets the DOIs of a collection that are not in the documents collection yet.
+        The collection is streamed and the DOIs are checked in chunks with one query per chunk.
+
+        Parameters
+        ----------
+        db : str
+            Name of the mongodb database
+        collection : str
+            Name of the collection inside db which contains the data
+        field : str
+            Name of the field with the DOI
+        chunk_size : int
+            Number of DOIs checked in each query. Default 1000
+
+        Returns
+        -------
+        doilist : list
+            DOIs in lowercase
+        '''
+        return list(self.iter_doilist_from_collection(db,collection,field,chunk_size=chunk_size))
             
+    def find_entity(self,collection,field,value):
+        '''
+        Finds an author, institution or source by one of its lookup fields.
+        The entity cache is checked first and the database is only queried for keys never seen before.
+
+        Parameters
+        ----------
+        collection : str
+            Name of the collection (authors, institutions or sources)
+        field : str
+            Lookup field, for example external_ids.value
+        value : str
+            Value to search
+
+        Returns
+        -------
+        entity : dict
+            Copy of the register found or None if it does not exist
+        '''
+        found,entity=self.entity_cache.get(collection,field,value)
+        if found:
+            return entity
+        entity=self.db[collection].find_one({field:value})
+        if entity:
+            self.entity_cache.put(collection,entity)
+        else:
+            self.entity_cache.put_missing(collection,field,value)
+        return entity
+
+    def find_entities(self,collection,field,values,chunk_size=1000):
+        '''
+        Finds in one $in query per chunk the authors, institutions or sources with any of the given values
+        in a lookup field and leaves them in the entity cache. The values without register are cached as missing.
+
+        Parameters
+        ----------
+        collection : str
+            Name of the collection (authors, institutions or sources)
+        field : str
+            Lookup field, for example external_ids.value
+        values : list
+            Values to search
+        chunk_size : int
+            Maximum number of values in each query. Default 1000
+
+        Returns
+        -------
+        entities : list
+            Registers found
+        '''
+        missing=[]
+        for value in set(values):
+            found,entity=self.entity_cache.get(collection,field,value)
+            if not found:
+                missing.append(value)
+        entities=[]
+        for i in range(0,len(missing),chunk_size):
+            chunk=missing[i:i+chunk_size]
+            for entity in self.db[collection].find({field:{"$in":chunk}}):
+                self.entity_cache.put(collection,entity)
+                entities.append(entity)
+            for value in chunk:
+                self.entity_cache.put_missing(collection,field,value)
+        return entities
+
+    def prefetch_entities(self,registers):
+        '''
+        Resolves all the authors, institutions and sources of a batch of transformed registers
+        with a few $in queries (one per collection and lookup field) instead of one find_one per id,
+        so link_authors_institutions and link_source are served from the entity cache.
+        The affiliations without external ids and the institutions of the sources without institution_id
+        are resolved through ROR and their GRID ids are fetched as well.
+
+        Parameters
+        ----------
+        registers : list
+            Transformed registers with the author_institutions and source keys
+        '''
+        author_ids=[]
+        aliases=[]
+        institution_ids=[]
+        names=[]
+        serials=[]
+        for register in registers:
+            for author in register["author_institutions"]:
+                author_ids.extend([idx["value"] for idx in author["external_ids"]])
+                aliases.extend(author["aliases"])
+                for affiliation in author["affiliations"]:
+                    institution_ids.extend([idx["value"] for idx in affiliation["external_ids"]])
+                    #as in link_authors_institutions, only the affiliations without ids are searched by name
+                    if affiliation["name"] and not affiliation["external_ids"]:
+                        names.append(affiliation["name"])
+            serials.extend([serial["value"] for serial in register["source"]["serials"]])
+
+        self.find_entities("authors","external_ids.value",author_ids)
+        self.find_entities("authors","aliases",aliases)
+        sources=self.find_entities("sources","serials.value",serials)
+        #as in link_source, the institution is searched only for the sources found without institution_id
+        sources_by_serial={}
+        for source in sources:
+            for serial in source.get("serials",[]):
+                sources_by_serial.setdefault(serial["value"],source)
+        for register in registers:
+            for serial in register["source"]["serials"]:
+                source=sources_by_serial.get(serial["value"])
+                if source:
+                    if not source.get("institution_id"):
+                        institution=source.get("institution") or register["source"].get("institution")
+                        if institution:
+                            names.append(institution)
+                    break
+        if names:
+            try:
+                responses=self.find_grid_institutions(names)
+            except Exception as e:
+                #The names not resolved here are requested again while linking
+                print("Could not prefetch affiliations")
+                print(e)
+                responses={}
+            for response in responses.values():
+                try:
+                    if response["number_of_results"]!=0:
+                        if response["items"][0]["score"]>0.8:
+                            institution_ids.append(response["items"][0]["organization"]["external_ids"]["GRID"]["preferred"])
+                except (KeyError,IndexError,TypeError):
+                    #ROR records without GRID id are skipped
+                    continue
+        institutions=self.find_entities("institutions","external_ids.value",institution_ids)
+        redirects=[institution["redirect"] for institution in institutions if "redirect" in institution.keys()]
+        if redirects:
+            self.find_entities("institutions","external_ids.value",redirects)
+
     def link_authors_institutions(self,author_institution):
         '''
         Searches for the author and affiliations in CoLav database.
@@ -555,13 +1027,13 @@ class KahiDb(KahiParser):
         author=None
         for id_ext in author_institution["external_ids"]:
             idx=id_ext["value"]
-            author=self.db["authors"].find_one({"external_ids.value":idx})
+            author=self.find_entity("authors","external_ids.value",idx)
             if author:
                 author_found=True
                 break
         if author_found==False: #search through aliases
             for alias in author_institution["aliases"]:
-                author=self.db["authors"].find_one({"aliases":alias})
+                author=self.find_entity("authors","aliases",alias)
                 if author:
                     author_found=True
                     break
@@ -629,7 +1101,7 @@ class KahiDb(KahiParser):
             affdb=None
             for id_ext in affiliation["external_ids"]: #try external_ids
                 idx=id_ext["value"]
-                affdb=self.db["institutions"].find_one({"external_ids.value":idx})
+                affdb=self.find_entity("institutions","external_ids.value",idx)
                 if affdb:
                     aff_found=True
                     break
@@ -638,10 +1110,10 @@ class KahiDb(KahiParser):
                 if response["number_of_results"]!=0:
                     if response["items"][0]["score"]>0.8:
                         gridid=response["items"][0]["organization"]["external_ids"]["GRID"]["preferred"]
-                        affdb=self.db["institutions"].find_one({"external_ids.value":gridid})
+                        affdb=self.find_entity("institutions","external_ids.value",gridid)
                         if affdb:
                             if "redirect" in affdb.keys():
-                                affdb=self.db["institutions"].find_one({"external_ids.value":affdb["redirect"]})
+                                affdb=self.find_entity("institutions","external_ids.value",affdb["redirect"])
                                 aff_found=True
                                 break
             if aff_found:
@@ -752,7 +1224,7 @@ class KahiDb(KahiParser):
         '''
         register=None
         for serial in source["serials"]:
-            register=self.db["sources"].find_one({"serials.value":serial["value"]})
+            register=self.find_entity("sources","serials.value",serial["value"])
             if register:
                 break
         if register:
@@ -772,7 +1244,7 @@ class KahiDb(KahiParser):
                     if response["number_of_results"]!=0:
                         if response["items"][0]["score"]>0.8:
                             gridid=response["items"][0]["organization"]["external_ids"]["GRID"]["preferred"]
-                            affdb=self.db["institutions"].find_one({"external_ids.value":gridid})
+                            affdb=self.find_entity("institutions","external_ids.value",gridid)
                             if affdb:
                                 mod["institution"]=affdb["name"]
                                 mod["institution_id"]=affdb["_id"]
@@ -786,7 +1258,7 @@ class KahiDb(KahiParser):
                     if response["number_of_results"]!=0:
                         if response["items"][0]["score"]>0.8:
                             gridid=response["items"][0]["organization"]["external_ids"]["GRID"]["preferred"]
-                            affdb=self.db["institutions"].find_one({"external_ids.value":gridid})
+                            affdb=self.find_entity("institutions","external_ids.value",gridid)
                             if affdb:
                                 mod["institution"]=affdb["name"]
                                 mod["institution_id"]=affdb["_id"]
@@ -861,17 +1333,173 @@ class KahiDb(KahiParser):
         return source
     
     
-    def insert_one(self,register):
+    def get_watermark(self,db,field="_id"):
+        '''
+        High-water mark of a raw database: the greatest value of field among the raw registers already processed
+        in incremental mode. Returns None if the database has never been processed incrementally.
+        '''
+        reg=self.db["watermarks"].find_one({"_id":db+self.db_suffix})
+        if not reg or reg["field"]!=field:
+            return None
+        return reg["value"]
+
+    def set_watermark(self,db,value,field="_id"):
+        '''
+        Saves the high-water mark of a raw database
+        '''
+        self.db["watermarks"].update_one({"_id":db+self.db_suffix},{"$set":{"field":field,"value":value,"updated":int(time())}},upsert=True)
+
+    def iter_new_raw_dois(self,db,field="_id",start=None):
+        '''
+        Yields the registers with DOI of a raw database whose field is greater than start, sorted by field.
+        With field _id these are the registers inserted after start, with an ingest timestamp field
+        the modified ones are also included.
+
+        Parameters
+        ----------
+        db : str
+            Name of the raw database (lens, wos, scopus, scholar or oadoi)
+        field : str
+            Field with the _id or the ingest timestamp. Default _id
+        start : ObjectId or int
+            Last value processed. Default None (the whole collection)
+
+        Yields
+        ------
+        (value, doi) : tuple
+            Value of field and DOI in lowercase, the DOI is empty if the register does not have it
+        '''
+        query={} if start is None else {field:{"$gt":start}}
+        doi_field="external_ids" if db=="lens" else "doi_idx"
+        for reg in self.raw_dbs[db][self.collection].find(query,{field:1,doi_field:1}).sort(field,1):
+            yield reg[field],self.raw_doi(db,reg)
+
+    def raw_doi(self,db,reg):
+        '''
+        DOI in lowercase of a register of a raw database, empty if it does not have it
+        '''
+        doi=""
+        if db=="lens":
+            for ext in reg["external_ids"] if reg.get("external_ids") else []:
+                if ext["type"]=="doi":
+                    doi=ext["value"]
+                    break
+        else:
+            doi=reg.get("doi_idx","")
+        return doi.lower() if doi else ""
+
+    def find_document(self,document):
+        '''
+        Finds a document in the CoLav database by its DOI
+
+        Parameters
+        ----------
+        document : dict
+            Document register in CoLav format
+
+        Returns
+        -------
+        register : dict
+            Document found or None
+        '''
+        dois=[ext["id"].lower() for ext in document["external_ids"] if ext["source"]=="doi" and ext["id"]]
+        if not dois:
+            return None
+        return self.db["documents"].find_one({"external_ids.id":{"$in":dois}})
+
+    def merge_document(self,register,document):
+        '''
+        Merges a new version of a document into the register in the CoLav database.
+        The empty fields of the register are filled with the new values,
+        the external ids missing are added and the checked sources are updated.
+
+        Parameters
+        ----------
+        register : dict
+            Document in the CoLav database
+        document : dict
+            New version of the document in CoLav format with the authors and the source already loaded
+
+        Returns
+        -------
+        result : pymongo.results.UpdateResult
+            Result of the update or None if there was nothing to modify
+        '''
+        mod={}
+        for key,value in document.items():
+            if key in ["_id","updated","external_ids","source_checked"]:
+                continue
+            if value and not register.get(key):
+                mod[key]=value
+        values=list(register.get("external_ids",[]))
+        modified=False
+        for value in document.get("external_ids",[]):
+            if not value in values:
+                values.append(value)
+                modified=True
+        if modified:
+            mod["external_ids"]=values
+        #the checked sources have the time of the run, only the newest one is kept for each source
+        values=[dict(value) for value in register.get("source_checked",[])]
+        modified=False
+        for source_checked in document.get("source_checked",[]):
+            found=False
+            for reg_checked in values:
+                if source_checked["source"]==reg_checked["source"]:
+                    found=True
+                    for field in ["date","ts"]:
+                        if field in source_checked.keys() and source_checked[field]>reg_checked.get(field,0):
+                            reg_checked[field]=source_checked[field]
+                            modified=True
+            if found==False:
+                values.append(source_checked)
+                modified=True
+        if modified:
+            mod["source_checked"]=values
+        if not mod:
+            return None
+        mod["updated"]=int(time())
+        return self.db["documents"].update_one({"_id":register["_id"]},{"$set":mod})
+
+    def insert_one(self,register,merge=False):
+        '''
+        Inserts a linked register in the CoLav database, inserting or modifying the source, institutions and authors.
+
+        Parameters
+        ----------
+        register : dict
+            Linked register with the keys document, author_institutions and source
+        merge : bool
+            If True and the document is already in the database (by its DOI), it is merged with merge_document
+            instead of inserted again. The authors and source of the document are kept when it has them:
+            the new ones are not inserted, but the modifications of the linked ones are applied. Default False
+
+        Returns
+        -------
+        result : pymongo.results.InsertOneResult or UpdateResult
+            Result of the document write
+        '''
+        found=None
+        if merge:
+            found=self.find_document(register["document"])
+        #the source and authors already in a merged document are kept, so the new ones are not inserted,
+        #but the modifications of the ones already in the database are applied
+        keep_source=bool(found and found.get("source"))
+        keep_authors=bool(found and found.get("authors"))
         #Source section
         if "id" in register["source"].keys():
             if "mod" in register["source"].keys():
                 response=self.db["sources"].update_one({"_id":register["source"]["id"]},{"$set":register["source"]["mod"]})
-        else:
+                self.entity_cache.update("sources",register["source"]["id"],register["source"]["mod"])
+        elif not keep_source:
             result=self.db["sources"].insert_one(register["source"])
+            self.entity_cache.put("sources",register["source"])
             register["source"]["id"]=result.inserted_id
         #removing all information but the id
-        source_id=register["source"]["id"]
-        register["source"]={"id":source_id}
+        if keep_source:
+            register["source"]=found["source"]
+        else:
+            register["source"]={"id":register["source"]["id"]}
 
         #author and affiliations section
         authors=[]
@@ -881,8 +1509,12 @@ class KahiDb(KahiParser):
                 if "id" in aff.keys(): #modify whats is needed
                     if "mod" in aff.keys():
                         result=self.db["institutions"].update_one({"_id":aff["id"]},{"$set":aff["mod"]})
+                        self.entity_cache.update("institutions",aff["id"],aff["mod"])
+                elif keep_authors:
+                    continue
                 else:#insert the affiliation and recover the id
                     result=self.db["institutions"].insert_one(aff)
+                    self.entity_cache.put("institutions",aff)
                     aff["id"]=result.inserted_id
                 #removing all information but the id
                 mongo_id=aff["id"]
@@ -891,22 +1523,54 @@ class KahiDb(KahiParser):
             if "id" in author.keys(): #modify what's needed
                 if "mod" in author.keys():
                     result=self.db["authors"].update_one({"_id":author["id"]},{"$set":author["mod"]})
+                    self.entity_cache.update("authors",author["id"],author["mod"])
+            elif keep_authors:
+                continue
             else: #insert the author and recover the id
                 del(author["affiliations"])
                 result=self.db["authors"].insert_one(author)
+                self.entity_cache.put("authors",author)
                 author["id"]=result.inserted_id
             #removing all information but the id
             author_id=author["id"]
             author={"id":author_id,"affiliations":affiliations,"corresponding":author["corresponding"]}
             authors.append(author)
+        if keep_authors:
+            authors=found["authors"]
 
         register["author_institutions"]=authors
         
         #Building the complete document register
         register["document"]["source"]=register["source"]
         register["document"]["authors"]=register["author_institutions"]
+        if found:
+            return self.merge_document(found,register["document"])
         result=self.db["documents"].insert_one(register["document"])
         return result
 
+    def insert_bulk(self,register):
+        '''
+        Queues the writes of a linked register to be sent with unordered bulk writes.
+        The ids of the new entities are assigned in the client, so they are valid
+        right away even if the writes are not flushed yet. Call flush when done.
+
+        Parameters
+        ----------
+        register : dict
+            Linked register with the keys document, author_institutions and source
+
+        Returns
+        -------
+        document_id : ObjectId
+            Id assigned to the document
+        '''
+        return self.loader.add(register)
+
+    def flush(self):
+        '''
+        Sends to the database the writes queued by insert_bulk
+        '''
+        self.loader.flush()
+
     def update_many(self,registry_list):
         pass
\ No newline at end of file
@@ -0,0 +1,116 @@
+from threading import Lock
+from time import time
+
+class RunJournal():
+    def __init__(self,db,name,collection="etl_journal"):
+        '''
+        Persistent progress journal of an ETL run stored in the CoLav database.
+        The input of the run is processed in numbered batches and every item has a key that grows
+        with the input order (the position in a DOI list or the _id of a raw register).
+        When a batch is committed its keys are recorded, and the boundary of the run (the last key of the
+        contiguous block of committed batches) is moved forward, so an interrupted run can be resumed
+        from the boundary without scanning again what was already processed.
+        The keys of the batches committed after the boundary (they can finish out of order) are kept
+        to skip them when resuming, and they are deleted once the boundary passes them.
+
+        The run is stored in the collection with the name as _id:
+        {"_id":name,"status":"running"|"finished","boundary":<key>,"batches":<int>,"processed":<int>,"started":<int>,"updated":<int>}
+        and the processed keys in the collection <collection>_items as {"run":name,"key":<key>}
+
+        Parameters
+        ----------
+        db : pymongo.database.Database
+            CoLav database
+        name : str
+            Name of the run, a run with the same name that did not finish is resumed
+        collection : str
+            Name of the collection of the journal. Default etl_journal
+        '''
+        self.name=name
+        self.runs=db[collection]
+        self.items=db[collection+"_items"]
+        self.items.create_index([("run",1),("key",1)])
+        self.lock=Lock()
+        self.pending={} #batch number: keys of the batch, for the batches behind the boundary
+        self.committed=set()
+        self.batches=0 #number of batches added
+        self.next_batch=0 #batch number following the boundary
+
+        run=self.runs.find_one({"_id":name})
+        if run and run["status"]=="running":
+            self.run=run
+            print("Resuming the run {} after {} processed registers".format(name,run["processed"]))
+        else:
+            self.items.delete_many({"run":name})
+            self.run={"_id":name,"status":"running","boundary":None,"batches":0,"processed":0,"started":int(time()),"updated":int(time())}
+            self.runs.replace_one({"_id":name},self.run,upsert=True)
+
+    @property
+    def boundary(self):
+        '''
+        Last key of the contiguous block of committed batches, None if nothing was committed
+        '''
+        return self.run["boundary"]
+
+    def processed_keys(self):
+        '''
+        Keys committed after the boundary, they must be skipped when resuming
+        '''
+        query={"run":self.name}
+        if not self.run["boundary"] is None:
+            query["key"]={"$gt":self.run["boundary"]}
+        return set(reg["key"] for reg in self.items.find(query,{"key":1,"_id":0}))
+
+    def add_batch(self,keys):
+        '''
+        Registers a new batch with the keys of its items in the input order
+
+        Returns
+        -------
+        number : int
+            Number of the batch, used to commit it
+        '''
+        with self.lock:
+            number=self.batches
+            self.batches+=1
+            self.pending[number]=list(keys)
+        return number
+
+    def commit_batch(self,number):
+        '''
+        Records that the items of the batch were loaded and moves the boundary forward if possible
+
+        Parameters
+        ----------
+        number : int
+            Number of the batch given by add_batch
+        '''
+        with self.lock:
+            keys=self.pending[number]
+            if keys:
+                self.items.insert_many([{"run":self.name,"key":key} for key in keys],ordered=False)
+            self.committed.add(number)
+            boundary=None
+            while self.next_batch in self.committed:
+                self.committed.remove(self.next_batch)
+                batch_keys=self.pending.pop(self.next_batch)
+                if batch_keys:
+                    boundary=batch_keys[-1]
+                self.next_batch+=1
+            mod={"processed":self.run["processed"]+len(keys),"batches":self.run["batches"]+1,"updated":int(time())}
+            if not boundary is None:
+                mod["boundary"]=boundary
+            self.runs.update_one({"_id":self.name},{"$set":mod})
+            self.run.update(mod)
+            if not boundary is None:
+                self.items.delete_many({"run":self.name,"key":{"$lte":boundary}})
+
+    def finish(self):
+        '''
+        Marks the run as finished, a new run with the same name will start from the beginning
+        '''
+        with self.lock:
+            mod={"status":"finished","updated":int(time())}
+            self.runs.update_one({"_id":self.name},{"$set":mod})
+            self.run.update(mod)
+            self.items.delete_many({"run":self.name})
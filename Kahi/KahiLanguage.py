@@ -0,0 +1,114 @@
+from collections import OrderedDict
+from threading import Lock
+import numpy as np
+import langid.langid as langid
+
+def normalize_title(title):
+    '''
+    Normalizes a title to be used as key of the language cache: lowercase and without repeated spaces
+    '''
+    return " ".join(str(title).lower().split())
+
+class LanguageDetector():
+    def __init__(self,max_size=100000,chunk_size=256):
+        '''
+        Language detection of titles with langid and a bounded LRU cache keyed on the normalized title,
+        so a title found in several raw databases is classified only once.
+        The original text is classified (langid is case sensitive), the normalized title is only the key.
+        The langid model is loaded the first time a title is classified.
+
+        Parameters
+        ----------
+        max_size : int
+            Maximum number of titles kept in the cache. Default 100000
+        chunk_size : int
+            Maximum number of titles classified together in one matrix product by classify_many. Default 256
+        '''
+        self.max_size=max_size
+        self.chunk_size=chunk_size
+        self.cache=OrderedDict()
+        self.lock=Lock()
+
+    def identifier(self):
+        if langid.identifier is None:
+            langid.load_model()
+        return langid.identifier
+
+    def get(self,key):
+        with self.lock:
+            if key in self.cache.keys():
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        return None
+
+    def put(self,key,result):
+        with self.lock:
+            self.cache[key]=result
+            self.cache.move_to_end(key)
+            while len(self.cache)>self.max_size:
+                self.cache.popitem(last=False)
+
+    def classify(self,title):
+        '''
+        Classifies the language of a title
+
+        Returns
+        -------
+        (lang, score) : tuple
+            The same result of langid.classify
+        '''
+        key=normalize_title(title)
+        result=self.get(key)
+        if result is None:
+            result=self.identifier().classify(title)
+            self.put(key,result)
+        return result
+
+    def classify_many(self,titles):
+        '''
+        Classifies the language of a list of titles. The titles missing in the cache are deduplicated
+        and scored in chunks with one matrix product per chunk instead of one per title.
+
+        Returns
+        -------
+        results : list
+            Tuples (lang, score) in the same order of the titles
+        '''
+        keys=[normalize_title(title) for title in titles]
+        found={}
+        missing=[]
+        for key,title in zip(keys,titles):
+            if key in found.keys():
+                continue
+            result=self.get(key)
+            found[key]=result
+            if result is None:
+                missing.append((key,title))
+        if missing:
+            identifier=self.identifier()
+            for i in range(0,len(missing),self.chunk_size):
+                chunk=missing[i:i+self.chunk_size]
+                features=np.vstack([identifier.instance2fv(title) for key,title in chunk])
+                scores=identifier.nb_classprobs(features)
+                for (key,title),row in zip(chunk,scores):
+                    probs=identifier.norm_probs(row)
+                    cl=np.argmax(probs)
+                    result=(str(identifier.nb_classes[cl]),float(probs[cl]))
+                    self.put(key,result)
+                    found[key]=result
+        return [found[key] for key in keys]
+
+#Detector shared by all the parsers of the process
+language_detector=LanguageDetector()
+
+def classify(title):
+    '''
+    Drop-in replacement of langid.classify that uses the shared cached detector
+    '''
+    return language_detector.classify(title)
+
+def classify_many(titles):
+    '''
+    Classifies a list of titles with the shared cached detector
+    '''
+    return language_detector.classify_many(titles)
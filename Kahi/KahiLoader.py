@@ -0,0 +1,138 @@
+from threading import Lock
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from bson.objectid import ObjectId
+
+class BulkLoader():
+    def __init__(self,db,batch_size=1000,cache=None):
+        '''
+        Loads linked registers in the CoLav database with unordered bulk writes.
+        The ObjectIds of the new sources, institutions, authors and documents are assigned
+        in the client when the register is added, so the references between them are valid
+        before the writes are sent. The operations are flushed with one bulk_write per collection
+        every time batch_size operations are queued.
+
+        Parameters
+        ----------
+        db : pymongo.database.Database
+            CoLav database
+        batch_size : int
+            Number of queued operations that triggers a flush. Default 1000
+        cache : EntityCache
+            Entity cache updated with the new and modified entities when they are queued,
+            so they are found while linking before being flushed. Default None
+        '''
+        self.db=db
+        self.cache=cache
+        self.batch_size=batch_size
+        self.collections=["sources","institutions","authors","documents"]
+        self.operations={collection:[] for collection in self.collections}
+        self.size=0
+        self.lock=Lock()
+
+    def queue(self,collection,operation):
+        self.operations[collection].append(operation)
+        self.size+=1
+
+    def cache_insert(self,collection,entity):
+        if self.cache:
+            self.cache.put(collection,entity)
+
+    def cache_update(self,collection,idx,mod):
+        if self.cache:
+            self.cache.update(collection,idx,mod)
+
+    def add(self,register):
+        '''
+        Queues the writes of a linked register, the same ones insert_one would do
+
+        Parameters
+        ----------
+        register : dict
+            Linked register with the keys document, author_institutions and source
+
+        Returns
+        -------
+        document_id : ObjectId
+            Id assigned to the document
+        '''
+        with self.lock:
+            #Source section
+            #the queued documents are only referenced by InsertOne, so the ids are kept apart
+            if "id" in register["source"].keys():
+                source_id=register["source"]["id"]
+                if "mod" in register["source"].keys():
+                    self.queue("sources",UpdateOne({"_id":source_id},{"$set":register["source"]["mod"]}))
+                    self.cache_update("sources",source_id,register["source"]["mod"])
+            else:
+                source_id=ObjectId()
+                register["source"]["_id"]=source_id
+                self.queue("sources",InsertOne(register["source"]))
+                self.cache_insert("sources",register["source"])
+            #removing all information but the id
+            register["source"]={"id":source_id}
+
+            #author and affiliations section
+            authors=[]
+            for author in register["author_institutions"]:
+                affiliations=[]
+                for aff in author["affiliations"]:
+                    if "id" in aff.keys(): #modify whats is needed
+                        aff_id=aff["id"]
+                        if "mod" in aff.keys():
+                            self.queue("institutions",UpdateOne({"_id":aff_id},{"$set":aff["mod"]}))
+                            self.cache_update("institutions",aff_id,aff["mod"])
+                    else:#insert the affiliation with a new id
+                        aff_id=ObjectId()
+                        aff["_id"]=aff_id
+                        self.queue("institutions",InsertOne(aff))
+                        self.cache_insert("institutions",aff)
+                    #removing all information but the id
+                    affiliations.append({"id":aff_id})
+                if "id" in author.keys(): #modify what's needed
+                    author_id=author["id"]
+                    if "mod" in author.keys():
+                        self.queue("authors",UpdateOne({"_id":author_id},{"$set":author["mod"]}))
+                        self.cache_update("authors",author_id,author["mod"])
+                else: #insert the author with a new id
+                    del(author["affiliations"])
+                    author_id=ObjectId()
+                    author["_id"]=author_id
+                    self.queue("authors",InsertOne(author))
+                    self.cache_insert("authors",author)
+                #removing all information but the id
+                authors.append({"id":author_id,"affiliations":affiliations,"corresponding":author["corresponding"]})
+            register["author_institutions"]=authors
+
+            #Building the complete document register
+            register["document"]["source"]=register["source"]
+            register["document"]["authors"]=register["author_institutions"]
+            register["document"]["_id"]=ObjectId()
+            self.queue("documents",InsertOne(register["document"]))
+            document_id=register["document"]["_id"]
+
+            if self.size>=self.batch_size:
+                self.flush_queued()
+        return document_id
+
+    def flush_queued(self):
+        '''
+        Sends the queued operations, it must be called with the lock acquired
+        '''
+        for collection in self.collections:
+            if not self.operations[collection]:
+                continue
+            try:
+                self.db[collection].bulk_write(self.operations[collection],ordered=False)
+            except BulkWriteError as e:
+                print("Some writes failed in the {} collection".format(collection))
+                print(e.details["writeErrors"])
+            self.operations[collection]=[]
+        self.size=0
+
+    def flush(self):
+        '''
+        Sends all the queued operations to the database
+        '''
+        with self.lock:
+            self.flush_queued()
@@ -1,7 +1,7 @@
 from pymongo import MongoClient
 import json
 from time import time
-from langid import classify
+from Kahi.KahiLanguage import classify_many
 from currency_converter import CurrencyConverter
 from fuzzywuzzy import fuzz,process
 import sys
@@ -133,6 +133,28 @@ class KahiParser():
         entry["subjects"]={}
         return entry
 
+    def prefetch_languages(self,registers):
+        '''
+        Classifies in one call the languages of the titles of a batch of raw registers,
+        the results are left in the language cache used by the parsers
+
+        Parameters
+        ----------
+        registers : list
+            Dicts with the raw database name as a key and the register as its value
+        '''
+        titles=[]
+        for data in registers:
+            if data["wos"] and "TI" in data["wos"].keys():
+                if data["wos"]["TI"] and data["wos"]["TI"]==data["wos"]["TI"]:
+                    titles.append(data["wos"]["TI"].strip())
+            if data["scopus"] and "Title" in data["scopus"].keys():
+                titles.append(data["scopus"]["Title"])
+            if data["lens"] and "title" in data["lens"].keys():
+                titles.append(data["lens"]["title"])
+        if titles:
+            classify_many(titles)
+
     def parse_document(self,data):
         parsed={
             "lens":None,
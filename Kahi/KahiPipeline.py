@@ -0,0 +1,191 @@
+from queue import Queue, Full, Empty
+from threading import Thread, Lock, Event
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from Kahi.KahiParser import KahiParser
+
+#Marks the end of the data in the queues between stages
+end_of_data=object()
+
+class StageError():
+    def __init__(self,stage,error):
+        '''
+        Wraps an exception raised inside a stage so it can be passed through the queues
+        and raised again in the consumer of the pipeline
+        '''
+        self.stage=stage
+        self.error=error
+
+#Parser of each transform worker process, created once by init_transform_worker
+transform_parser=None
+
+def init_transform_worker():
+    global transform_parser
+    transform_parser=KahiParser()
+
+def transform_register(register):
+    '''
+    Parses and joins one raw register (dict with the raw database name as key) in CoLav's format
+    '''
+    entry={}
+    entry["document"]=transform_parser.join_document(transform_parser.parse_document(register))
+    entry["author_institutions"]=transform_parser.join_authors_institutions(transform_parser.parse_authors_institutions(register))
+    entry["source"]=transform_parser.join_source(transform_parser.parse_source(register))
+    return entry
+
+def transform_batch(batch):
+    '''
+    Transforms a batch of raw registers in a worker process
+    '''
+    transform_parser.prefetch_languages(batch)
+    return [transform_register(register) for register in batch]
+
+def transform_pool(n_workers):
+    '''
+    Process pool for the CPU-bound parse and join steps, each process holds its own parser.
+    The processes are started with spawn instead of fork, because the pool is used from the pipeline threads
+    while the pymongo and requests threads are running, and forking a multithreaded process can copy held locks.
+    The spawned processes import the main module again, so the scripts using the pool must run Kahi
+    inside an if __name__=="__main__": block.
+    '''
+    return ProcessPoolExecutor(max_workers=max(1,n_workers),initializer=init_transform_worker,mp_context=get_context("spawn"))
+
+def batched(iterable,size):
+    '''
+    Groups the items of an iterable in lists of at most size items without reading it in advance
+    '''
+    batch=[]
+    for item in iterable:
+        batch.append(item)
+        if len(batch)>=size:
+            yield batch
+            batch=[]
+    if batch:
+        yield batch
+
+class Pipeline():
+    def __init__(self,stages,queue_size=4):
+        '''
+        Streaming pipeline of stages connected by bounded queues.
+        Each stage runs in its own threads, takes one item from the previous queue,
+        and puts the result in the next one. When a queue is full the previous stage waits,
+        so at most queue_size items are kept between two stages no matter how long the input is.
+
+        Parameters
+        ----------
+        stages : list
+            List of tuples (name, function, number of workers). The function receives an item
+            and returns the item for the next stage, None results are dropped.
+        queue_size : int
+            Maximum number of items waiting in each queue. Default 4
+        '''
+        self.stages=stages
+        self.queue_size=queue_size
+
+    def put(self,queue,item):
+        '''
+        Puts an item in a queue waiting while it is full, unless the pipeline is stopped
+
+        Returns
+        -------
+        put : bool
+            False if the pipeline was stopped before the item could be put
+        '''
+        while not self.stop.is_set():
+            try:
+                queue.put(item,timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def get(self,queue):
+        '''
+        Gets an item from a queue, returns end_of_data if the pipeline is stopped
+        '''
+        while True:
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                if self.stop.is_set():
+                    return end_of_data
+
+    def feed(self,iterable,queue,n_workers):
+        try:
+            for item in iterable:
+                if self.failed or self.stop.is_set():
+                    break
+                if not self.put(queue,item):
+                    break
+        except Exception as e:
+            self.failed=True
+            self.put(queue,StageError("input",e))
+        for i in range(n_workers):
+            self.put(queue,end_of_data)
+
+    def work(self,name,function,queue_in,queue_out,n_next):
+        '''
+        Loop of a stage worker. The last worker of the stage to finish sends the end marks to the next stage
+        '''
+        while not self.stop.is_set():
+            item=self.get(queue_in)
+            if item is end_of_data:
+                break
+            if isinstance(item,StageError):
+                self.put(queue_out,item)
+                continue
+            if self.failed: #drain the queue without processing
+                continue
+            try:
+                result=function(item)
+            except Exception as e:
+                self.failed=True
+                result=StageError(name,e)
+            if not result is None:
+                self.put(queue_out,result)
+        with self.lock:
+            self.running[name]-=1
+            last=self.running[name]==0
+        if last:
+            for i in range(n_next):
+                self.put(queue_out,end_of_data)
+
+    def run(self,iterable):
+        '''
+        Runs the pipeline over the iterable and yields the results of the last stage as they are ready.
+        If a stage raises an exception the pipeline is drained and the exception is raised here.
+        If the consumer stops early (break, close or an exception) the stages are stopped and joined.
+        '''
+        self.lock=Lock()
+        self.stop=Event()
+        self.failed=False
+        self.running={name:n_workers for name,function,n_workers in self.stages}
+        queues=[Queue(maxsize=self.queue_size) for i in range(len(self.stages)+1)]
+        threads=[Thread(target=self.feed,args=(iterable,queues[0],self.stages[0][2]),daemon=True)]
+        for i,(name,function,n_workers) in enumerate(self.stages):
+            n_next=self.stages[i+1][2] if i+1<len(self.stages) else 1
+            for j in range(n_workers):
+                threads.append(Thread(target=self.work,args=(name,function,queues[i],queues[i+1],n_next),daemon=True))
+        for thread in threads:
+            thread.start()
+        error=None
+        try:
+            while True:
+                item=queues[-1].get()
+                if item is end_of_data:
+                    break
+                if isinstance(item,StageError):
+                    if error is None:
+                        error=item
+                    continue
+                if error is None:
+                    yield item
+        finally:
+            #the threads blocked on full or empty queues see the stop and finish
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+        if error:
+            print("The pipeline failed in the {} stage".format(error.stage))
+            raise error.error
@@ -0,0 +1,349 @@
+import json
+import re
+import sqlite3
+import urllib.parse
+import zipfile
+from math import log
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, BoundedSemaphore
+from time import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from unidecode import unidecode
+from rapidfuzz import fuzz
+
+def normalize_affiliation(text):
+    '''
+    Normalizes an affiliation name to be used as cache key:
+    lowercase, without accents, punctuation or repeated spaces
+    '''
+    text=unidecode(str(text).lower())
+    text=re.sub(r'[^\w\s]',' ',text)
+    return " ".join(text.split())
+
+class RorResolver():
+    def __init__(self,ror_url='https://api.ror.org/organizations?affiliation=',cache_size=100000,cache_file=None,concurrency=10,timeout=30,retries=3,backoff=0.5):
+        '''
+        Resolves affiliation names with the ROR affiliation API (local or remote).
+        The responses are kept in an in-process LRU cache and optionally in a sqlite file,
+        both keyed on the normalized affiliation name, so the service is only requested
+        for names never seen before, even across runs.
+        The requests share a pooled keep-alive session with timeouts and retries with backoff,
+        and at most concurrency requests are sent at the same time.
+
+        Parameters
+        ----------
+        ror_url : str
+            Url of the ROR affiliation endpoint, the affiliation name is appended to it
+        cache_size : int
+            Maximum number of responses kept in memory. Default 100000
+        cache_file : str
+            Path to the sqlite file used as persistent cache. Default None (no persistent cache)
+        concurrency : int
+            Maximum number of simultaneous requests to the service. Default 10
+        timeout : float
+            Seconds to wait for the service to respond. Default 30
+        retries : int
+            Number of retries for failed connections and 429 or 5xx responses. Default 3
+        backoff : float
+            Backoff factor in seconds between retries. Default 0.5
+        '''
+        self.ror_url=ror_url
+        self.cache_size=cache_size
+        self.cache=OrderedDict()
+        self.lock=Lock()
+        self.hits=0
+        self.misses=0
+
+        self.concurrency=max(1,concurrency)
+        self.timeout=timeout
+        self.semaphore=BoundedSemaphore(self.concurrency)
+        self.session=requests.Session()
+        retry=Retry(total=retries,backoff_factor=backoff,status_forcelist=[429,500,502,503,504])
+        adapter=HTTPAdapter(pool_connections=self.concurrency,pool_maxsize=self.concurrency,max_retries=retry)
+        self.session.mount("http://",adapter)
+        self.session.mount("https://",adapter)
+
+        self.store=None
+        if cache_file:
+            self.store=sqlite3.connect(cache_file,check_same_thread=False)
+            self.store.execute("CREATE TABLE IF NOT EXISTS ror (key TEXT PRIMARY KEY, response TEXT, updated INTEGER)")
+            self.store.commit()
+
+    def get_cached(self,key):
+        '''
+        Looks for the response of a normalized name in memory and then in the persistent cache.
+        Returns None if it was not found
+        '''
+        with self.lock:
+            if key in self.cache.keys():
+                self.cache.move_to_end(key)
+                self.hits+=1
+                return self.cache[key]
+            if self.store:
+                row=self.store.execute("SELECT response FROM ror WHERE key=?",(key,)).fetchone()
+                if row:
+                    result=json.loads(row[0])
+                    self.put_memory(key,result)
+                    self.hits+=1
+                    return result
+            self.misses+=1
+        return None
+
+    def put_memory(self,key,result):
+        self.cache[key]=result
+        self.cache.move_to_end(key)
+        while len(self.cache)>self.cache_size:
+            self.cache.popitem(last=False)
+
+    def put(self,key,result):
+        '''
+        Saves the response of a normalized name in memory and in the persistent cache
+        '''
+        with self.lock:
+            self.put_memory(key,result)
+            if self.store:
+                self.store.execute("INSERT OR REPLACE INTO ror (key,response,updated) VALUES (?,?,?)",(key,json.dumps(result),int(time())))
+                self.store.commit()
+
+    def request(self,token):
+        '''
+        Requests the ROR service for the given affiliation name.
+        Raises NameError if the server does not respond with status 200.
+
+        Returns
+        -------
+        result : dict
+            ROR result dictionary and a boolean telling if the response is valid to be cached
+        '''
+        query=urllib.parse.quote(token)
+        url='{}{}'.format(self.ror_url,query)
+        with self.semaphore:
+            res=self.session.get(url,timeout=self.timeout)
+        if res.status_code!=200:
+            raise NameError("Server responded to the request {} with status error: {}".format(query,res.status_code))
+        result={}
+        try:
+            result=res.json()
+        except Exception as e:
+            result["number_of_results"]=0
+            return result,False
+        return result,True
+
+    def try_request(self,token):
+        '''
+        Requests the ROR service as request does, but a failed request is reported and returned
+        as an empty result not valid to be cached, so it does not affect the other requests of a batch
+        '''
+        try:
+            return self.request(token)
+        except Exception as e:
+            print("Could not resolve the affiliation {} with ROR".format(token))
+            print(e)
+            return {"number_of_results":0},False
+
+    def resolve(self,token):
+        '''
+        Finds the institution through a keyword or name.
+        The cache is checked first and the ROR service is only requested for new names.
+
+        Parameters
+        ----------
+        token : str
+            The key expression to search within the ROR db
+
+        Returns
+        -------
+        result : dict
+            ROR result dictionary with the number of results and the full information of them
+        '''
+        if not token:
+            result={}
+            result["number_of_results"]=0
+            return result
+        key=normalize_affiliation(token)
+        result=self.get_cached(key)
+        if result is None:
+            result,valid=self.request(token)
+            if valid:
+                self.put(key,result)
+        return result
+
+    def resolve_many(self,tokens):
+        '''
+        Resolves a list of affiliation names concurrently.
+        The names are deduplicated and only the ones missing in the cache are requested to the service.
+        The names whose request fails get an empty result (not cached), the rest are resolved anyway.
+
+        Parameters
+        ----------
+        tokens : list of str
+            Affiliation names
+
+        Returns
+        -------
+        results : dict
+            Name as key and the ROR result dictionary as value
+        '''
+        results={}
+        missing={}
+        for token in tokens:
+            if token in results.keys() or token in missing.keys():
+                continue
+            if not token:
+                results[token]={"number_of_results":0}
+                continue
+            key=normalize_affiliation(token)
+            result=self.get_cached(key)
+            if result is None:
+                missing[token]=key
+            else:
+                results[token]=result
+        if not missing:
+            return results
+        pending={}
+        for token,key in missing.items():
+            if not key in pending.keys():
+                pending[key]=token
+        with ThreadPoolExecutor(max_workers=min(self.concurrency,len(pending))) as executor:
+            responses=dict(zip(pending.keys(),executor.map(self.try_request,pending.values())))
+        for token,key in missing.items():
+            result,valid=responses[key]
+            if valid:
+                self.put(key,result)
+            results[token]=result
+        return results
+
+    def close(self):
+        '''
+        Closes the http session and the persistent cache
+        '''
+        self.session.close()
+        with self.lock:
+            if self.store:
+                self.store.close()
+                self.store=None
+
+class RorDumpResolver(RorResolver):
+    def __init__(self,dump_file,cache_size=100000,max_candidates=50):
+        '''
+        Resolves affiliation names offline with a ROR data dump loaded in memory.
+        The names, aliases, acronyms and labels of the organizations are kept in an inverted index
+        of normalized tokens, and the results have the same shape of the ROR affiliation API:
+        {"number_of_results":<int>,"items":[{"score":<float>,"matching_type":<str>,"chosen":<bool>,"organization":<dict>}]}
+
+        Parameters
+        ----------
+        dump_file : str
+            Path to the ROR dump, either the json file or the zip file with it
+        cache_size : int
+            Maximum number of responses kept in memory. Default 100000
+        max_candidates : int
+            Maximum number of organizations scored for each name, the ones sharing the rarest tokens. Default 50
+        '''
+        super().__init__(ror_url="",cache_size=cache_size,concurrency=1)
+        self.max_candidates=max_candidates
+        self.organizations=[]
+        self.names=[] #list of (normalized name, is acronym) for each organization
+        self.exact={}
+        self.index={}
+
+        for org in self.load_dump(dump_file):
+            position=len(self.organizations)
+            self.organizations.append(org)
+            names=[]
+            if org.get("name"):
+                names.append((org["name"],False))
+            for alias in org.get("aliases",[]):
+                names.append((alias,False))
+            for label in org.get("labels",[]):
+                if label.get("label"):
+                    names.append((label["label"],False))
+            for acronym in org.get("acronyms",[]):
+                names.append((acronym,True))
+            normalized=[]
+            for name,acronym in names:
+                name=normalize_affiliation(name)
+                if not name:
+                    continue
+                normalized.append((name,acronym))
+                if not acronym:
+                    if not name in self.exact.keys():
+                        self.exact[name]=position
+                for token in name.split():
+                    if not token in self.index.keys():
+                        self.index[token]=set()
+                    self.index[token].add(position)
+            self.names.append(normalized)
+        print("Loaded {} organizations from the ROR dump".format(len(self.organizations)))
+
+    def load_dump(self,dump_file):
+        '''
+        Reads the list of organizations from the ROR dump (json or zipped json)
+        '''
+        if dump_file.endswith(".zip"):
+            with zipfile.ZipFile(dump_file) as archive:
+                name=[name for name in archive.namelist() if name.endswith(".json")][0]
+                with archive.open(name) as f:
+                    return json.load(f)
+        with open(dump_file) as f:
+            return json.load(f)
+
+    def candidates(self,tokens):
+        '''
+        Organizations sharing tokens with the query, sorted by the sum of the inverse frequency of the shared tokens
+        '''
+        weights={}
+        total=len(self.organizations)
+        for token in set(tokens):
+            if not token in self.index.keys():
+                continue
+            idf=log(1+total/len(self.index[token]))
+            for position in self.index[token]:
+                weights[position]=weights.get(position,0)+idf
+        return sorted(weights.keys(),key=lambda position:-weights[position])[:self.max_candidates]
+
+    def request(self,token):
+        '''
+        Searches the affiliation name in the dump index.
+        The name is compared as a whole and split by commas (as in "department, university, city, country")
+        against every name of the candidate organizations. An exact name gets score 1 and acronyms only count when they are exact.
+
+        Returns
+        -------
+        result : dict
+            ROR result dictionary and a boolean telling if the response is valid to be cached
+        '''
+        parts=[normalize_affiliation(part) for part in token.split(",")]
+        parts=[part for part in parts if part]
+        query=normalize_affiliation(token)
+        if query and not query in parts:
+            parts.insert(0,query)
+        items=[]
+        exact=[self.exact[part] for part in parts if part in self.exact.keys()]
+        if exact:
+            items.append({"score":1.0,"matching_type":"EXACT","chosen":True,"organization":self.organizations[exact[0]]})
+        else:
+            scored=[]
+            for position in self.candidates(query.split()):
+                score=0
+                for name,acronym in self.names[position]:
+                    for part in parts:
+                        if acronym:
+                            ratio=80 if part==name else 0
+                        else:
+                            ratio=fuzz.ratio(part,name)
+                        if ratio>score:
+                            score=ratio
+                if score>0:
+                    scored.append((score/100,position))
+            scored.sort(key=lambda item:-item[0])
+            for score,position in scored:
+                items.append({"score":score,"matching_type":"FUZZY","chosen":False,"organization":self.organizations[position]})
+            if items and items[0]["score"]>0.9:
+                items[0]["chosen"]=True
+        result={"number_of_results":len(items),"items":items}
+        return result,True
@@ -0,0 +1,546 @@
+import re
+from multiprocessing import get_context
+from threading import Lock
+from unidecode import unidecode
+import numpy as np
+from rapidfuzz import fuzz
+from rapidfuzz.process import cdist
+from rapidfuzz.utils import default_process
+from fuzzywuzzy.fuzz import partial_ratio as block_partial_ratio
+
+#Words too common in titles to be useful as blocking keys
+stopwords=set([
+    "with","from","that","this","these","those","their","them","into","about","between","under","over",
+    "using","based","study","analysis","among","case","para","entre","como","sobre","desde","hacia",
+    "estudio","analisis","caso","uma","pela","pelo","dans","pour","avec","und","durch","eine"
+])
+
+def parse_string(text):
+    text = unidecode(text.lower())
+    text = re.sub( r'[\$_\^]','', re.sub(r'\\\w+','',text ))
+    return str(text)
+
+def year_key(year):
+    '''
+    Normalizes a publication year to an int to be used as a blocking key.
+    Returns None when the year is missing or could not be parsed.
+    '''
+    if not year:
+        return None
+    try:
+        return int(year)
+    except:
+        try:
+            return int(str(year)[:4])
+        except:
+            return None
+
+def text_tokens(text,min_length=4):
+    '''
+    Tokens of a title already normalized with parse_string, words shorter than min_length and stopwords are dropped
+    '''
+    return set(token for token in re.split(r'\W+',text) if len(token)>=min_length and not token in stopwords)
+
+def title_tokens(title,min_length=4):
+    '''
+    Normalized tokens of a title used as blocking keys.
+    The normalization is the same used by colav_similarity before scoring
+    (lowercase, no accents, no latex commands), words shorter than min_length and stopwords are dropped.
+    '''
+    if not title:
+        return set()
+    return text_tokens(parse_string(str(title)),min_length)
+
+def prepare_candidates(titles,sources,years):
+    '''
+    Normalizes once the similarity lists, so only the query has to be normalized when scoring.
+
+    Parameters
+    ----------
+    titles : list
+        Titles of the candidates
+    sources : list
+        Journals of the candidates
+    years : list
+        Publication years of the candidates
+
+    Returns
+    -------
+    prepared : dict
+        Dict with one list per column, in the order of the candidates:
+        titles (normalized with parse_string), splits (titles splitted by brackets and processed for the comparison
+        of titles in several languages, None if any part is too short), long (more than three words),
+        tokens (blocking keys), sources (lowercase without accents, None if missing) and years (int or None)
+    '''
+    prepared={"titles":[],"splits":[],"long":[],"tokens":[],"sources":[],"years":[]}
+    for title,source,year in zip(titles,sources,years):
+        text=parse_string(str(title)) if title else ""
+        parts=text.split("[")
+        prepared["titles"].append(text)
+        prepared["splits"].append([default_process(part) for part in parts] if min([len(part) for part in parts])>10 else None)
+        prepared["long"].append(bool(title) and len(text.split())>3)
+        prepared["tokens"].append(text_tokens(text) if title else set())
+        prepared["sources"].append(unidecode(str(source).lower()) if source else None)
+        prepared["years"].append(year_key(year))
+    prepared["long"]=np.array(prepared["long"],dtype=bool)
+    return prepared
+
+class SimilarityIndex():
+    def __init__(self):
+        '''
+        Blocking index over the similarity lists of one raw database.
+        The positions of the registers in the lists are stored in blocks keyed on
+        the normalized title tokens, so a query only has to be compared against the registers
+        that share at least one title token.
+        The year is not part of the blocks: colav_similarity accepts long titles whatever their years are,
+        and only short titles (three words or less) need the same year, so those queries are filtered by it.
+
+        Registers without usable tokens are stored under the None key and are always returned as candidates.
+        '''
+        self.blocks={}
+        self.keys={}
+        self.years={}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self,position,title,year,tokens=None):
+        '''
+        Adds the register at the given position of the similarity lists to the index.
+        The tokens of the title can be given if they were already computed
+        '''
+        if tokens is None:
+            tokens=title_tokens(title)
+        keys=set(tokens)
+        if not keys:
+            keys=set([None])
+        for key in keys:
+            if not key in self.blocks.keys():
+                self.blocks[key]=set()
+            self.blocks[key].add(position)
+        self.keys[position]=keys
+        self.years[position]=year_key(year)
+
+    def remove(self,position):
+        '''
+        Removes the register at the given position from the index.
+        The similarity lists are not modified, so the rest of positions remain valid
+        '''
+        if not position in self.keys.keys():
+            return
+        for key in self.keys.pop(position):
+            self.blocks[key].discard(position)
+            if not self.blocks[key]:
+                del(self.blocks[key])
+        del(self.years[position])
+
+    def candidates(self,title,year):
+        '''
+        Finds the positions of the registers that should be compared with the query
+
+        Parameters
+        ----------
+        title : str
+            Title of the query
+        year : int or str
+            Publication year of the query
+
+        A query without usable tokens can not be blocked, so every register of the index is a candidate
+        (the same as the full scan of colav_similarity). A short query can only match registers of its same year.
+
+        Returns
+        -------
+        List of positions in the similarity lists sorted in ascending order
+        '''
+        tokens=title_tokens(title)
+        if not tokens:
+            found=set(self.keys.keys())
+        else:
+            found=set()
+            for token in list(tokens)+[None]:
+                block=self.blocks.get(token)
+                if block:
+                    found.update(block)
+        if len(parse_string(str(title) if title else "").split())<=3:
+            year=year_key(year)
+            found=[position for position in found if not year is None and self.years[position]==year]
+        return sorted(found)
+
+def exact_partial_ratios(scores,queries,choices,bound):
+    '''
+    Recomputes with fuzzywuzzy the partial ratios greater than bound.
+    fuzzywuzzy (used by colav_similarity) only compares the windows aligned with the matching blocks,
+    so its partial ratio is equal or lower than the optimal one of rapidfuzz, and only the scores that
+    could pass a threshold need to be computed again.
+    The scores are the same as colav_similarity's when fuzzywuzzy uses its python-Levenshtein backend
+    (listed in the requirements), the pure python one finds other matching blocks.
+
+    Parameters
+    ----------
+    scores : numpy.ndarray
+        Partial ratios of rapidfuzz, one per choice
+    queries : list
+        Strings compared with each choice, the best score is kept
+    choices : list
+        Strings of each score
+    bound : int
+        Lowest threshold the scores are compared with
+
+    Returns
+    -------
+    scores : numpy.ndarray
+        The same scores with the ones greater than bound recomputed
+    '''
+    scores=np.array(scores,dtype=float)
+    for k in np.flatnonzero(scores>bound):
+        scores[k]=max([block_partial_ratio(query,choices[k]) for query in queries])
+    return scores
+
+def prepared_scores(title,source,prepared,rows,low_thold=80):
+    '''
+    Computes in one vectorized call the scores used by colav_similarity
+    between one query and some rows of the prepared candidates (see prepare_candidates).
+    Only the query is normalized here.
+
+    Parameters
+    ----------
+    title : str
+        Title of the query
+    source : str
+        Journal of the query
+    prepared : dict
+        Candidates normalized with prepare_candidates
+    rows : list
+        Positions of the candidates to compare
+    low_thold : int
+        Lowest threshold of the partial ratios, the ones above it are computed as fuzzywuzzy does. Default 80
+
+    Returns
+    -------
+    scores : numpy.ndarray
+        Matrix with one row per candidate and the columns:
+        ratio, partial ratio, best ratio over the bracket splitted titles (-1 if not applicable),
+        best partial ratio over the bracket splitted titles (-1 if not applicable) and journal partial ratio (-1 if a journal is missing).
+    '''
+    n=len(rows)
+    scores=np.full((n,5),-1,dtype=np.int32)
+    if n==0:
+        return scores
+    title=parse_string(title if title else "")
+    titles=[prepared["titles"][i] for i in rows]
+
+    #Direct comparisons
+    scores[:,0]=np.rint(cdist([title],titles,scorer=fuzz.ratio,workers=1)[0])
+    partials=cdist([title],titles,scorer=fuzz.partial_ratio,workers=1)[0]
+    scores[:,1]=np.rint(exact_partial_ratios(partials,[title],titles,low_thold))
+
+    #Comparisons when the title comes in several languages
+    title_list=title.split("[")
+    if min([len(item) for item in title_list]) > 10:
+        title_list=[default_process(item) for item in title_list]
+        flat=[]
+        starts=[]
+        owners=[]
+        for k,i in enumerate(rows):
+            candidate_list=prepared["splits"][i]
+            if candidate_list:
+                starts.append(len(flat))
+                owners.append(k)
+                flat.extend(candidate_list)
+        if flat:
+            ratios=cdist(title_list,flat,scorer=fuzz.ratio,workers=1).max(axis=0)
+            partials=cdist(title_list,flat,scorer=fuzz.partial_ratio,workers=1).max(axis=0)
+            partials=exact_partial_ratios(partials,title_list,flat,low_thold)
+            scores[owners,2]=np.rint(np.maximum.reduceat(ratios,starts))
+            scores[owners,3]=np.rint(np.maximum.reduceat(partials,starts))
+
+    #Journals
+    if source:
+        mask=[k for k,i in enumerate(rows) if not prepared["sources"][i] is None]
+        if mask:
+            journals=[prepared["sources"][rows[k]] for k in mask]
+            journal=unidecode(source.lower())
+            partials=cdist([journal],journals,scorer=fuzz.partial_ratio,workers=1)[0]
+            scores[mask,4]=np.rint(exact_partial_ratios(partials,[journal],journals,low_thold))
+    return scores
+
+def similarity_scores(title,source,titles,sources):
+    '''
+    Computes in one vectorized call the scores used by colav_similarity
+    between one query and a whole column of candidates (see prepared_scores).
+
+    Parameters
+    ----------
+    title : str
+        Title of the query
+    source : str
+        Journal of the query
+    titles : list
+        Titles of the candidates
+    sources : list
+        Journals of the candidates
+
+    Returns
+    -------
+    scores : numpy.ndarray
+        Matrix with one row per candidate and the columns described in prepared_scores
+    '''
+    prepared=prepare_candidates(titles,sources,[None]*len(titles))
+    return prepared_scores(title,source,prepared,list(range(len(titles))))
+
+def prepared_similarity_batch(title,source,year,prepared,rows,ratio_thold=90,partial_thold=95,low_thold=80):
+    '''
+    Vectorized version of colav_similarity that compares one query against some rows of the prepared candidates.
+    It applies the same thresholds and the same journal, year and length checks.
+
+    Parameters
+    ----------
+    title : str
+        Title of the query
+    source : str
+        Journal of the query
+    year : int or str
+        Publication year of the query
+    prepared : dict
+        Candidates normalized with prepare_candidates
+    rows : list
+        Positions of the candidates to compare
+
+    Returns
+    -------
+    idx : int
+        Index in rows of the first candidate that passes the similarity check, None if there is not any
+    '''
+    n=len(rows)
+    if n==0:
+        return None
+    scores=prepared_scores(title,source,prepared,rows,low_thold=min(low_thold,ratio_thold))
+
+    journal_check=scores[:,4]>ratio_thold
+    year=year_key(year)
+    if year:
+        year_check=np.array([prepared["years"][i]==year for i in rows],dtype=bool)
+    else:
+        year_check=np.zeros(n,dtype=bool)
+    both_check=journal_check & year_check
+
+    length=len(parse_string(title if title else "").split())>3
+    length_check=prepared["long"][rows] & length
+
+    label=length_check & (scores[:,0]>ratio_thold)
+    label|=scores[:,2]>ratio_thold
+    label|=scores[:,3]>partial_thold
+    label|=both_check & (scores[:,3]>low_thold)
+    label|=length_check & (scores[:,1]>partial_thold)
+    label|=both_check & (scores[:,1]>low_thold)
+    #If the titles are short and there is not journal or year to check, the candidate is discarded
+    label&=length_check | both_check
+
+    found=np.flatnonzero(label)
+    if len(found)==0:
+        return None
+    return int(found[0])
+
+def colav_similarity_batch(title,source,year,titles,sources,years,ratio_thold=90,partial_thold=95,low_thold=80):
+    '''
+    Vectorized version of colav_similarity that compares one query against a list of candidates
+    (see prepared_similarity_batch).
+
+    Parameters
+    ----------
+    title : str
+        Title of the query
+    source : str
+        Journal of the query
+    year : int or str
+        Publication year of the query
+    titles : list
+        Titles of the candidates
+    sources : list
+        Journals of the candidates
+    years : list
+        Publication years of the candidates
+
+    Returns
+    -------
+    idx : int
+        Index of the first candidate that passes the similarity check, None if there is not any
+    '''
+    prepared=prepare_candidates(titles,sources,years)
+    return prepared_similarity_batch(title,source,year,prepared,list(range(len(titles))),
+        ratio_thold=ratio_thold,partial_thold=partial_thold,low_thold=low_thold)
+
+def similarity_worker(connection):
+    '''
+    Main loop of a similarity worker process.
+    The worker holds in memory its shard of the similarity lists of each raw database
+    and answers the messages received through the connection:
+
+    ("load",db,positions,titles,sources,years) stores a shard, positions are the global indexes of the registers
+    ("remove",db,position) removes a register from the search
+    ("query",db,title,source,year) replies with the global index of the first register that passes the similarity check or None
+    ("stop",) finishes the loop
+
+    A message that fails is reported and, if it is a query, answered with None, so the worker keeps serving.
+    '''
+    shards={}
+    while True:
+        try:
+            message=connection.recv()
+        except EOFError:
+            #the parent process is gone
+            break
+        action=message[0]
+        if action=="stop":
+            break
+        try:
+            reply=similarity_action(shards,message)
+        except Exception as e:
+            #a bad message must not kill the worker, the queries are answered as not found
+            print("The similarity worker could not process a {} message".format(action))
+            print(e)
+            reply=None
+        if action=="query":
+            connection.send(reply)
+    connection.close()
+
+def similarity_action(shards,message):
+    '''
+    Processes a load, remove or query message of similarity_worker
+
+    Returns
+    -------
+    idx : int
+        For the queries, the global index of the first register that passes the similarity check or None
+    '''
+    action=message[0]
+    if action=="load":
+        db,positions,titles,sources,years=message[1:]
+        #the shard is normalized once, the queries only normalize their own title
+        prepared=prepare_candidates(titles,sources,years)
+        del(titles,sources)
+        index=SimilarityIndex()
+        for i in range(len(positions)):
+            index.add(i,None,years[i],tokens=prepared["tokens"][i])
+        del(prepared["tokens"])
+        shards[db]={
+            "positions":positions,
+            "local":{position:i for i,position in enumerate(positions)},
+            "prepared":prepared,
+            "index":index
+        }
+    elif action=="remove":
+        db,position=message[1:]
+        if db in shards.keys() and position in shards[db]["local"].keys():
+            shards[db]["index"].remove(shards[db]["local"][position])
+    elif action=="query":
+        db,title,source,year=message[1:]
+        if db in shards.keys():
+            shard=shards[db]
+            candidates=shard["index"].candidates(title,year)
+            if candidates:
+                found=prepared_similarity_batch(title,source,year,shard["prepared"],candidates)
+                if not found is None:
+                    return shard["positions"][candidates[found]]
+    return None
+
+class SimilarityPool():
+    def __init__(self,n_workers=1):
+        '''
+        Long-lived pool of processes for the similarity search.
+        The similarity lists of each raw database are split in shards, one per worker,
+        that are sent only once when the database is loaded.
+        A query is broadcasted to every worker and the first match in the lists order is returned,
+        so the result is the same as searching the full lists sequentially.
+        The workers are started with spawn, as the transform processes (see transform_pool),
+        because the pool is created while the pymongo threads are already running.
+
+        Parameters
+        ----------
+        n_workers : int
+            Number of worker processes. Default 1
+        '''
+        self.n_workers=max(1,n_workers)
+        self.connections=[]
+        self.workers=[]
+        self.sizes={}
+        self.removed={}
+        self.lock=Lock()
+        context=get_context("spawn")
+        for i in range(self.n_workers):
+            parent,child=context.Pipe()
+            worker=context.Process(target=similarity_worker,args=(child,),daemon=True)
+            worker.start()
+            child.close()
+            self.connections.append(parent)
+            self.workers.append(worker)
+
+    def __len__(self):
+        return sum(self.sizes.values())-sum([len(removed) for removed in self.removed.values()])
+
+    def size(self,db):
+        '''
+        Number of registers of the given raw database still available for the similarity search
+        '''
+        if not db in self.sizes.keys():
+            return 0
+        return self.sizes[db]-len(self.removed[db])
+
+    def load(self,db,titles,sources,years):
+        '''
+        Distributes the similarity lists of a raw database among the workers.
+        The register at index i of the lists goes to the worker i modulo the number of workers.
+        '''
+        with self.lock:
+            for k,connection in enumerate(self.connections):
+                positions=list(range(k,len(titles),self.n_workers))
+                connection.send(("load",db,positions,
+                    [titles[i] for i in positions],
+                    [sources[i] for i in positions],
+                    [years[i] for i in positions]))
+            self.sizes[db]=len(titles)
+            self.removed[db]=set()
+
+    def remove(self,db,position):
+        '''
+        Removes the register at the given index of the similarity lists from the search
+        '''
+        with self.lock:
+            if not db in self.removed.keys() or position in self.removed[db]:
+                return
+            self.connections[position%self.n_workers].send(("remove",db,position))
+            self.removed[db].add(position)
+
+    def query(self,db,title,source,year):
+        '''
+        Searches the first register of the raw database that passes the similarity check
+
+        Returns
+        -------
+        idx : int
+            Index of the register in the similarity lists, None if it was not found
+        '''
+        with self.lock:
+            for connection in self.connections:
+                connection.send(("query",db,title,source,year))
+            found=[connection.recv() for connection in self.connections]
+        found=[idx for idx in found if not idx is None]
+        if not found:
+            return None
+        return min(found)
+
+    def close(self):
+        '''
+        Stops the workers
+        '''
+        with self.lock:
+            for connection in self.connections:
+                try:
+                    connection.send(("stop",))
+                    connection.close()
+                except:
+                    pass
+            for worker in self.workers:
+                worker.join()
+            self.connections=[]
+            self.workers=[]
@@ -0,0 +1,94 @@
+from threading import Thread
+from pymongo.errors import PyMongoError, OperationFailure
+
+class RawWatcher():
+    def __init__(self,kahi,db,queue,stop,use_change_streams=True,poll_interval=10):
+        '''
+        Tails the stage collection of a raw database and puts the new or modified registers
+        in a queue as tuples (raw database, _id, doi).
+        A mongodb change stream is used when the server supports it (replica set),
+        otherwise the collection is polled every poll_interval seconds for _ids greater than the last one seen.
+        The registers inserted while Kahi was stopped are read first, after the high-water mark of the database.
+
+        Parameters
+        ----------
+        kahi : Kahi
+            Kahi instance, used to read the raw databases and the high-water marks
+        db : str
+            Name of the raw database (lens, wos, scopus, scholar or oadoi)
+        queue : queue.Queue
+            Queue where the registers found are put
+        stop : threading.Event
+            Event that finishes the watcher
+        use_change_streams : bool
+            If False the collection is always polled. Default True
+        poll_interval : float
+            Seconds between polls and between attempts to open the change stream. Default 10
+        '''
+        self.kahi=kahi
+        self.db=db
+        self.queue=queue
+        self.stop=stop
+        self.use_change_streams=use_change_streams
+        self.poll_interval=poll_interval
+        self.last=kahi.get_watermark(db)
+        self.thread=Thread(target=self.run,daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def join(self,timeout=None):
+        self.thread.join(timeout)
+
+    def poll(self):
+        '''
+        Puts in the queue the registers with _id greater than the last one seen
+        '''
+        for idx,doi in self.kahi.iter_new_raw_dois(self.db,"_id",self.last):
+            if self.stop.is_set():
+                return
+            self.queue.put((self.db,idx,doi))
+            self.last=idx
+
+    def watch(self):
+        '''
+        Follows the change stream of the stage collection until the watcher is stopped.
+        Raises OperationFailure if the server does not support change streams
+        '''
+        collection=self.kahi.raw_dbs[self.db][self.kahi.collection]
+        pipeline=[{"$match":{"operationType":{"$in":["insert","update","replace"]}}}]
+        with collection.watch(pipeline,full_document="updateLookup",max_await_time_ms=1000) as stream:
+            #the registers inserted before the stream was opened
+            self.poll()
+            while not self.stop.is_set():
+                change=stream.try_next()
+                if change is None:
+                    continue
+                reg=change.get("fullDocument")
+                if not reg:
+                    continue
+                self.queue.put((self.db,reg["_id"],self.kahi.raw_doi(self.db,reg)))
+                #updates of older registers do not move the mark back
+                if self.last is None or reg["_id"]>self.last:
+                    self.last=reg["_id"]
+
+    def run(self):
+        while not self.stop.is_set():
+            if self.use_change_streams:
+                try:
+                    self.watch()
+                    continue
+                except OperationFailure as e:
+                    print("Change streams not available for {}, polling the collection instead".format(self.db+self.kahi.db_suffix))
+                    self.use_change_streams=False
+                except PyMongoError as e:
+                    print("The change stream of {} failed, trying again".format(self.db+self.kahi.db_suffix))
+                    print(e)
+                    self.stop.wait(self.poll_interval)
+                    continue
+            try:
+                self.poll()
+            except PyMongoError as e:
+                print("Could not poll {}".format(self.db+self.kahi.db_suffix))
+                print(e)
+            self.stop.wait(self.poll_interval)
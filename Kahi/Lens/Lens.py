@@ -1,7 +1,7 @@
 from time import time
 from datetime import datetime as dt
-import iso3166
-from langid import classify
+from Kahi.KahiCountry import resolve_country
+from Kahi.KahiLanguage import classify
 
 class Lens():
     def __init__(self):
@@ -335,46 +335,9 @@ class Lens():
 
             if "country" in reg["source"].keys():
                 if reg["source"]["country"]:
-                    if reg["source"]["country"].lower()=="united kingdom":
-                        source["country"]='GB'
-                    elif reg["source"]["country"].lower()=="venezuela":
-                        source["country"]='VE'
-                    elif reg["source"]["country"].lower()=="united states":
-                        source["country"]='US'
-                    elif reg["source"]["country"].lower()=="czech republic":
-                        source["country"]="CZ"
-                    elif reg["source"]["country"].lower()=="vietnam":
-                        source["country"]="VN"
-                    elif reg["source"]["country"].lower()=="russia":
-                        source["country"]="RU"
-                    elif reg["source"]["country"].lower()=="peoples r china":
-                        source["country"]="CN"
-                    elif reg["source"]["country"].lower()=="scotland":
-                        source["country"]="GB"
-                    elif reg["source"]["country"].lower()=="iran":
-                        source["country"]="IR"
-                    elif reg["source"]["country"].lower()=="south korea":
-                        source["country"]="KR"
-                    elif reg["source"]["country"].lower()=="u arab emirates":
-                        source["country"]="AE"
-                    elif reg["source"]["country"].lower()=="dem rep congo":
-                        source["country"]="CD"
-                    elif reg["source"]["country"].lower()=="tanzania":
-                        source["country"]="TZ"
-                    elif reg["source"]["country"].lower()=="taiwan":
-                        source["country"]="TW"
-                    elif reg["source"]["country"].lower()=="wales":
-                        source["country"]="GB"
-                    elif reg["source"]["country"].lower()=="micronesia":
-                        source["country"]="FM"
-                    elif reg["source"]["country"].lower()=="bolivia":
-                        source["country"]="BO"
-                    else:
-                        try:
-                            source["country"]=iso3166.countries_by_name.get(reg["source"]["country"].upper()).alpha2
-                        except:
-                            print("Could not parse: ",reg["source"]["country"].upper())
-                            source["country"]=""
+                    source["country"]=resolve_country(reg["source"]["country"])
+                    if not source["country"]:
+                        print("Could not parse: ",reg["source"]["country"].upper())
 
             serial=[]
             if "issn" in reg["source"].keys():
@@ -1,9 +1,10 @@
 from time import time
 from datetime import datetime as dt
-import iso3166
+from Kahi.KahiCountry import resolve_country
 import iso639
 import json
 from fuzzywuzzy import fuzz
+from Kahi.WebOfScience.WosRegister import wos_register
 
 # TODO:
 # * Check how the email, orcidid and researcherid in the author information
@@ -70,31 +71,23 @@ class Scielo():
         if "DT" in register.keys():
             if register["DT"] and register["DT"]==register["DT"]:
                 data["publication_type"]=register["DT"].rstrip().lower()
-        if "PT" in register.keys():
-            if register["PT"].rstrip()=="J":
-                if "AU" in register.keys():
-                    data["author_count"]=len(register["AU"].rstrip().split("\n"))
-            elif register["PT"].rstrip()=="B":
-                data["publication_type"]="book"
-                if "BA" in register.keys():
-                    data["author_count"]=len(register["BA"].rstrip().split("\n"))
-            elif register["PT"].rstrip()=="S":
-                data["publication_type"]="series"
-                if "AU" in register.keys():
-                    data["author_count"]=len(register["AU"].rstrip().split("\n"))
-            elif register["PT"].rstrip()=="P":
-                data["publication_type"]="patent"
-                if "AU" in register.keys():
-                    data["author_count"]=len(register["AU"].rstrip().split("\n"))
+        view=wos_register(register)
+        if "PT" in register.keys() and register["PT"].rstrip()=="B":
+            data["publication_type"]="book"
+            if view.ba:
+                data["author_count"]=len(view.ba)
+        else:
+            if "PT" in register.keys():
+                if register["PT"].rstrip()=="S":
+                    data["publication_type"]="series"
+                elif register["PT"].rstrip()=="P":
+                    data["publication_type"]="patent"
+                elif register["PT"].rstrip()!="J":
+                    data["publication_type"]=""
             else:
                 data["publication_type"]=""
-                if "AU" in register.keys():
-                    data["author_count"]=len(register["AU"].rstrip().split("\n"))
-        else:
-            data["publication_type"]=""
-            if "AU" in register.keys():
-                data["author_count"]=len(register["AU"].rstrip().split("\n"))
-        
+            if view.au:
+                data["author_count"]=len(view.au)
             
         if "TI" in register.keys():
             if register["TI"] and register["TI"]==register["TI"]:
@@ -194,22 +187,12 @@ class Scielo():
             Information of the authors in the CoLav standard format
         """
         authors=[]
-        corresponding_last_name=""
-        orcid_list=[]
-        researchid_list=[]
-        if "RI" in register.keys():
-            if register["RI"] and register["RI"]==register["RI"]:
-                researchid_list=register["RI"].rstrip().split("; ")
-        if "OI" in register.keys():
-            if register["OI"] and register["OI"]==register["OI"]:
-                orcid_list=register["OI"].rstrip().replace("; ",";").split(";")
-        if "AF" in register.keys():
-            author_list=register["AF"].rstrip().split("\n")
-        elif "AU" in register.keys():
-            author_list=register["AU"].rstrip().lower().split("\n")
-        if "RP" in register.keys():
-            if register["RP"]:
-                corresponding_last_name=register["RP"].split(",")[0]
+        view=wos_register(register)
+        author_list=[]
+        if view.af:
+            author_list=view.af
+        elif view.au:
+            author_list=[au.lower() for au in view.au]
         for au in author_list:
             entry={}
             entry["first_names"]=""
@@ -240,32 +223,20 @@ class Scielo():
             entry["last_names"]=last_names
             #Checking if there is an external id
             entry_ext=[]
-            for res in researchid_list:
-                try:
-                    name,rid=res.split("/")
-                except Exception as e:
-                    print("Could not split name and id in researchid field on ",register["doi_idx"])
-                    print(e)
+            for name,rid in view.researchids:
                 if fuzz.partial_ratio(name,last_names+", "+names)>0.8:
                     entry_ext.append({"source":"researchid","value":rid})
                     break
-            for res in orcid_list:
-                try:
-                    name,oid=res.split("/")
-                except Exception as e:
-                    print("Could not split name and id in orcid field on ",register["doi_idx"])
-                    print(e)
+            for name,oid in view.orcids:
                 if fuzz.partial_ratio(name,last_names+", "+names)>0.8:
                     entry_ext.append({"source":"orcid","value":oid})
                     break
             entry["external_ids"]=entry_ext
             #Checking if is corresponding author
-            if corresponding_last_name:
-                if corresponding_last_name in last_names:
+            if view.corresponding_last_name:
+                if view.corresponding_last_name in last_names:
                     entry["corresponding"]=True
-                    if "EM" in register.keys():
-                        if register["EM"] and register["EM"]==register["EM"]:
-                            entry["corresponding_email"]=register["EM"].rstrip()
+                    entry["corresponding_email"]=view.email
             authors.append(entry)
         if len(authors)==1:
             authors[0]["corresponding"]=True
@@ -288,65 +259,12 @@ class Scielo():
         inst=[]
         #if "" in register.keys(): inst[""]=register[""]
         if "C1" in register.keys():
-            C1=register["C1"].strip().replace(".","")
-            for auwaf in C1.split("\n"):
-                aulen=len(auwaf.split(";"))
-                if aulen==1:
-                    auaff=auwaf.split("] ")
-                    if len(auaff)==1:
-                        aff=auwaf
-                        authors=[""]
-                        if "AF" in register.keys():
-                            if len(register["AF"].rstrip().split("\n"))==1:
-                                authors=register["AF"].rstrip()
-                    else:
-                        aff=auaff[1]
-                        authors=[auaff[0][1:]]
-                else:
-                    aff=auwaf.split("] ")[1]
-                    authors=auwaf.split("] ")[0][1:].split("; ")
+            for authors,aff in wos_register(register).c1:
                 try:
                     name="".join(aff.split(", ")[0])
                 except:
                     name=""
-                if aff.split(", ")[-1].replace(".","").upper()=="ENGLAND":
-                    country="GB"
-                elif aff.split(", ")[-1].replace(".","").upper()=="CZECH REPUBLIC":
-                    country="CZ"
-                elif aff.split(", ")[-1].replace(".","").upper()=="VENEZUELA":
-                    country="VE"
-                elif aff.split(", ")[-1].replace(".","").upper()=="VIETNAM":
-                    country="VN"
-                elif aff.split(", ")[-1].replace(".","").upper()=="RUSSIA":
-                    country="RU"
-                elif aff.split(", ")[-1].replace(".","").upper()=="PEOPLES R CHINA":
-                    country="CN"
-                elif aff.split(", ")[-1].replace(".","").upper()=="SCOTLAND":
-                    country="GB"
-                elif aff.split(", ")[-1].replace(".","").upper()=="IRAN":
-                    country="IR"
-                elif aff.split(", ")[-1].replace(".","").upper()=="SOUTH KOREA":
-                    country="KR"
-                elif aff.split(", ")[-1].replace(".","").upper()=="U ARAB EMIRATES":
-                    country="AE"
-                elif aff.split(", ")[-1].replace(".","").upper()=="DEM REP CONGO":
-                    country="CD"
-                elif aff.split(", ")[-1].replace(".","").upper()=="TANZANIA":
-                    country="TZ"
-                elif aff.split(", ")[-1].replace(".","").upper()=="TAIWAN":
-                    country="TW"
-                elif aff.split(", ")[-1].replace(".","").upper()=="WALES":
-                    country="GB"
-                elif aff.split(", ")[-1].replace(".","").upper()=="MICRONESIA":
-                    country="FM"
-                elif aff.split(", ")[-1].replace(".","").upper()[-3:]=="USA":
-                    country="US"
-                else:
-                    try:
-                        country=iso3166.countries_by_name.get(aff.split(", ")[-1].replace(".","").upper()).alpha2
-                    except:
-                        #print("could not parse: ",aff.split(", ")[-1].replace(".","").upper())
-                        country=""
+                country=resolve_country(aff.split(", ")[-1],usa_suffix=True)
                 for i in range(len(authors)):
                     author=authors[i] if authors else ""
                     inst.append({"name":name,"countries":country,"author":author}) ##LAST PART OF aff HAS THE COUNTRY
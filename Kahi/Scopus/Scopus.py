@@ -1,11 +1,10 @@
 from time import time
 from datetime import datetime as dt
-import iso3166
+from Kahi.KahiCountry import resolve_country, find_countries
 import iso639
 from fuzzywuzzy import fuzz,process
 from re import split,UNICODE
-from geotext import GeoText
-from langid import classify
+from Kahi.KahiLanguage import classify
 
 class Scopus():
     def __init__(self):
@@ -156,6 +155,34 @@ class Scopus():
 
         return data
 
+    def split_affiliations(self,affiliations):
+        """
+        Splits the affiliations string of an author in the affiliations ending with a country,
+        using the country mentions found by the compiled country matcher in one pass
+
+        Parameters
+        ----------
+        affiliations : str
+           Affiliations of an author as given by a scopus register
+        
+        Returns
+        -------
+        affiliation_list : list
+            Tuples (name, alpha2 country code). The last one is what is left after the last country mention
+            with the code of that mention, empty if no country was found
+        """
+        spans=find_countries(affiliations)
+        affiliation_list=[]
+        start=0
+        for span_start,span_end,country_alpha2 in spans[:-1]:
+            affiliation_list.append((affiliations[start:span_end],country_alpha2))
+            start=span_end
+            while start<len(affiliations) and affiliations[start] in ",; ":
+                start+=1
+        country_alpha2=spans[-1][2] if spans else ""
+        affiliation_list.append((affiliations[start:],country_alpha2))
+        return affiliation_list
+
     def check_country(self,country):
         """
         Transforms the name of a country (given by a scopus register) in its alpha2 code
@@ -170,47 +197,7 @@ class Scopus():
         country_code : str
             Uppercase alpha2 country code
         """
-        if country=="United Kingdom":
-            country_alpha2="GB"
-        elif country.lower()=="venezuela":
-            country_alpha2='VE'
-        elif country.lower()=="united states":
-            country_alpha2='US'
-        elif country.lower()=="czech republic":
-            country_alpha2="CZ"
-        elif country.lower()=="vietnam":
-            country_alpha2="VN"
-        elif country.lower()=="russia":
-            country_alpha2="RU"
-        elif country.lower()=="peoples r china":
-            country_alpha2="CN"
-        elif country.lower()=="scotland":
-            country_alpha2="GB"
-        elif country.lower()=="iran":
-            country_alpha2="IR"
-        elif country.lower()=="south korea":
-            country_alpha2="KR"
-        elif country.lower()=="u arab emirates":
-            country_alpha2="AE"
-        elif country.lower()=="dem rep congo":
-            country_alpha2="CD"
-        elif country.lower()=="tanzania":
-            country_alpha2="TZ"
-        elif country.lower()=="taiwan":
-            country_alpha2="TW"
-        elif country.lower()=="wales":
-            country_alpha2="GB"
-        elif country.lower()=="micronesia":
-            country_alpha2="FM"
-        elif country.lower()=="reunion":
-            return ""
-        else:
-            try:
-                country_alpha2=country=iso3166.countries_by_name.get(country.upper()).alpha2
-            except:
-                #print("Could not parse: ",country)
-                country_alpha2=""
-        return country_alpha2
+        return resolve_country(country)
 
     def parse_authors(self,reg):
         """
@@ -360,11 +347,9 @@ class Scopus():
                     else:
                         author=auaf[1]
                         affiliations=auaf[-1]
-                    countries=GeoText(affiliations).countries
-                    for country in countries[:-1]:
-                        country_affiliation_list=affiliations.split(country+', ')
-                        country_alpha2 = self.check_country(country)
-                        entry_aff={"name":country_affiliation_list[0]+country,
+                    affiliation_list=self.split_affiliations(affiliations)
+                    for name,country_alpha2 in affiliation_list[:-1]:
+                        entry_aff={"name":name,
                                 "abbreviations":[],
                                 "aliases":[],
                                 "external_ids":[],
@@ -373,14 +358,8 @@ class Scopus():
                                 "addresses":[{"country":country_alpha2}],
                                 "external_urls":[]}
                         entry["affiliations"].append(entry_aff)
-                        inst.append({"name":country_affiliation_list[0]+country,"author":author,"countries":country_alpha2})
-                        affiliations=country_affiliation_list[-1] #what is left
-                    try:
-                        #print(i,countries[-1])
-                        country_alpha2 = self.check_country(countries[-1])
-                    except:
-                        #print("Could not parse country")
-                        country_alpha2=""
+                        inst.append({"name":name,"author":author,"countries":country_alpha2})
+                    affiliations,country_alpha2=affiliation_list[-1] #what is left
                     
                     entry_aff={"name":affiliations,
                                 "aliases":[],
@@ -464,17 +443,10 @@ class Scopus():
                     else:
                         author=auaf[1]
                         affiliations=auaf[-1]
-                    countries=GeoText(affiliations).countries
-                    for country in countries[:-1]:
-                        country_affiliation_list=affiliations.split(country+', ')
-                        country_alpha2 = self.check_country(country)
-                        inst.append({"name":country_affiliation_list[0]+country,"author":author,"countries":country_alpha2})
-                        affiliations=country_affiliation_list[-1] #what is left
-                    try:
-                        country_alpha2 = self.check_country(countries[-1])
-                    except:
-                        #print("Could not parse country")
-                        country_alpha2=""
+                    affiliation_list=self.split_affiliations(affiliations)
+                    for name,country_alpha2 in affiliation_list[:-1]:
+                        inst.append({"name":name,"author":author,"countries":country_alpha2})
+                    affiliations,country_alpha2=affiliation_list[-1] #what is left
                     inst.append({"name":affiliations,"author":author,"countries":country_alpha2})
 
         return inst
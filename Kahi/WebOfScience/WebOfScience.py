@@ -1,10 +1,11 @@
 from time import time
 from datetime import datetime as dt
-import iso3166
+from Kahi.KahiCountry import resolve_country
 import iso639
 import json
 from fuzzywuzzy import fuzz
-from langid import classify
+from Kahi.KahiLanguage import classify
+from Kahi.WebOfScience.WosRegister import wos_register, split_name, name_key, initials_key
 
 # TODO:
 # * Check how the email, orcidid and researcherid in the author information
@@ -72,30 +73,23 @@ class WebOfScience():
         if "DT" in register.keys():
             if register["DT"] and register["DT"]==register["DT"]:
                 data["publication_type"]=register["DT"].rstrip().lower()
-        if "PT" in register.keys():
-            if register["PT"].rstrip()=="J":
-                if "AU" in register.keys():
-                    data["author_count"]=len(register["AU"].rstrip().split("\n"))
-            elif register["PT"].rstrip()=="B":
-                data["publication_type"]="book"
-                if "BA" in register.keys():
-                    data["author_count"]=len(register["BA"].rstrip().split("\n"))
-            elif register["PT"].rstrip()=="S":
-                data["publication_type"]="series"
-                if "AU" in register.keys():
-                    data["author_count"]=len(register["AU"].rstrip().split("\n"))
-            elif register["PT"].rstrip()=="P":
-                data["publication_type"]="patent"
-                if "AU" in register.keys():
-                    data["author_count"]=len(register["AU"].rstrip().split("\n"))
+        view=wos_register(register)
+        if "PT" in register.keys() and register["PT"].rstrip()=="B":
+            data["publication_type"]="book"
+            if view.ba:
+                data["author_count"]=len(view.ba)
+        else:
+            if "PT" in register.keys():
+                if register["PT"].rstrip()=="S":
+                    data["publication_type"]="series"
+                elif register["PT"].rstrip()=="P":
+                    data["publication_type"]="patent"
+                elif register["PT"].rstrip()!="J":
+                    data["publication_type"]=""
             else:
                 data["publication_type"]=""
-                if "AU" in register.keys():
-                    data["author_count"]=len(register["AU"].rstrip().split("\n"))
-        else:
-            data["publication_type"]=""
-            if "AU" in register.keys():
-                data["author_count"]=len(register["AU"].rstrip().split("\n"))
+            if view.au:
+                data["author_count"]=len(view.au)
             
         if "TI" in register.keys():
             if register["TI"] and register["TI"]==register["TI"]:
@@ -199,27 +193,9 @@ class WebOfScience():
         authors=[]
         if "PT" in register.keys():
             #if register["PT"].rstrip()=="J":
-            corresponding_last_name=""
-            orcid_list=[]
-            researchid_list=[]
-            if "RI" in register.keys():
-                if register["RI"] and register["RI"]==register["RI"]:
-                    ri=register["RI"]
-                    if ri[-1]=="\n":
-                        ri=ri[:-1]
-                    researchid_list=ri.rstrip().replace("; ",";").split(";")
-            if "OI" in register.keys():
-                if register["OI"] and register["OI"]==register["OI"]:
-                    oi=register["OI"]
-                    if oi[-1]=="\n":
-                        oi=oi[:-1]
-                    orcid_list=oi.rstrip().replace("; ",";").split(";")
-            if "AF" in register.keys():
-                author_list=register["AF"].rstrip().split("\n")
-                if "RP" in register.keys():
-                    if register["RP"]:
-                        corresponding_last_name=register["RP"].split(",")[0]
-                for au in author_list:
+            view=wos_register(register)
+            if view.af:
+                for au in view.af:
                     entry={}
                     entry["first_names"]=""
                     entry["national_id"]=""
@@ -233,16 +209,7 @@ class WebOfScience():
                     entry["corresponding"]=False
                     entry["corresponding_address"]=""
                     entry["corresponding_email"]=""
-                    raw_name=au.split(", ")
-                    if len(raw_name)==1:
-                        names=raw_name[0].capitalize()
-                        last_names=""
-                    elif len(raw_name)>2:
-                        names=" ".join(raw_name[:-1]).rstrip().capitalize()
-                        last_names=raw_name[-1].capitalize()
-                    else:
-                        names=raw_name[1].capitalize()
-                        last_names=raw_name[0].capitalize()
+                    names,last_names=split_name(au)
 
                     entry["full_name"]=names+" "+last_names
                     entry["first_names"]=names
@@ -250,90 +217,67 @@ class WebOfScience():
                     entry["initials"]="".join([i[0].upper() for i in names.split(" ")])
                     #Checking if there is an external id
                     entry_ext=[]
-                    for res in researchid_list:
-                        if not res:
-                            continue
-                        try:
-                            name,rid=res.split("/")[-2:]
-                        except Exception as e:
-                            print("Could not split name and id in researchid field on ",register["doi_idx"])
-                            print(e)
-                        ratio=fuzz.partial_ratio(name,last_names+", "+names)
-                        if ratio>90:
-                            entry_ext.append({"source":"researchid","value":rid})
-                            break
-                        elif ratio>50:
-                            ratio=fuzz.token_set_ratio(name,last_names+", "+names)
-                            if ratio>90:
-                                entry_ext.append({"source":"researchid","value":rid})
-                                break
-                            elif ratio>50:
-                                ratio=fuzz.partial_token_set_ratio(name,last_names+", "+names)
-                                if ratio>95:
-                                    entry_ext.append({"source":"researchid","value":rid})
-                                    break
-                    for res in orcid_list:
-                        if not res:
-                            continue
-                        try:
-                            name,oid=res.split("/")[-2:]
-                        except Exception as e:
-                            print("Could not split name and id in orcid field on ",register["doi_idx"])
-                            print(e)
-                        ratio=fuzz.partial_ratio(name,last_names+", "+names)
-                        if ratio>90:
-                            entry_ext.append({"source":"orcid","value":oid})
-                            break
-                        elif ratio>50:
-                            ratio=fuzz.token_set_ratio(name,last_names+", "+names)
-                            if ratio>90:
-                                entry_ext.append({"source":"orcid","value":oid})
-                                break
-                            elif ratio>50:
-                                ratio=fuzz.partial_token_set_ratio(name,last_names+", "+names)
-                                if ratio>95:
-                                    entry_ext.append({"source":"orcid","value":oid})
-                                    break
+                    rid=self.match_external_id(view.researchids,last_names+", "+names)
+                    if rid:
+                        entry_ext.append({"source":"researchid","value":rid})
+                    oid=self.match_external_id(view.orcids,last_names+", "+names)
+                    if oid:
+                        entry_ext.append({"source":"orcid","value":oid})
                     entry["external_ids"]=entry_ext
                     #Checking if is corresponding author
-                    if corresponding_last_name:
-                        if corresponding_last_name in last_names:
+                    if view.corresponding_last_name:
+                        if view.corresponding_last_name in last_names:
                             entry["corresponding"]=True
-                            if "EM" in register.keys():
-                                if register["EM"] and register["EM"]==register["EM"]:
-                                    entry["corresponding_email"]=register["EM"].rstrip()
+                            entry["corresponding_email"]=view.email
                     authors.append(entry)
                 if len(authors)==1:
                     authors[0]["corresponding"]=True
         return authors
 
+    def match_external_id(self,ids,name):
+        """
+        Finds the id of an author in the list of (name, id) tuples of the RI or OI fields
+
+        Parameters
+        ----------
+        ids : list
+           Tuples (name, id) from the tokenized register
+        name : str
+           Name of the author as "last names, first names"
+
+        Returns
+        -------
+        id : str
+            The id of the first name that matches, None if there is no match
+        """
+        for id_name,idx in ids:
+            ratio=fuzz.partial_ratio(id_name,name)
+            if ratio>90:
+                return idx
+            elif ratio>50:
+                ratio=fuzz.token_set_ratio(id_name,name)
+                if ratio>90:
+                    return idx
+                elif ratio>50:
+                    ratio=fuzz.partial_token_set_ratio(id_name,name)
+                    if ratio>95:
+                        return idx
+        return None
+
     def parse_authors_institutions(self,register):
         authors=[]
         if "C1" in register.keys():
             if register["C1"]:
-
-                corresponding_last_name=""
-                orcid_list=[]
-                researchid_list=[]
-                if "RI" in register.keys():
-                    if register["RI"] and register["RI"]==register["RI"]:
-                        researchid_list=register["RI"].rstrip().replace("; ",";").split(";")
-                if "OI" in register.keys():
-                    if register["OI"] and register["OI"]==register["OI"]:
-                        orcid_list=register["OI"].rstrip().replace("; ",";").split(";")
-                
                 institutions=self.parse_institutions(register)
                 raw_authors=self.parse_authors(register)
+                index,initials_index=self.index_institutions(institutions,raw_authors)
                 for author in raw_authors:
                     author["affiliations"]=[]
-                    for institution in institutions:
-                        if institution["author"]=="":
-                            continue
-                        if fuzz.token_set_ratio(author["full_name"],institution["author"])>=80:
-                            inst=institution.copy()
-                            del(inst["author"])
-                            author["affiliations"].append(inst)
-                            break
+                    institution=self.match_institution(author,institutions,index,initials_index)
+                    if institution:
+                        inst=institution.copy()
+                        del(inst["author"])
+                        author["affiliations"].append(inst)
                     authors.append(author)
                 for institution in institutions: #searching empty institutions and append a false author
                     if institution["author"]=="":
@@ -362,6 +306,73 @@ class WebOfScience():
 
         return authors
 
+    def index_institutions(self,institutions,authors):
+        """
+        Indexes the institutions by the names of their authors
+
+        Parameters
+        ----------
+        institutions : list
+           Institutions as given by parse_institutions, one per author
+        authors : list
+           Authors as given by parse_authors
+
+        Returns
+        -------
+        index : dict
+            Position of the first institution of each name key (see name_key)
+        initials_index : dict
+            Position of the first institution of each initials key (see initials_key),
+            only for the keys of a single author in both the C1 field and the authors list
+        """
+        index={}
+        initials_positions={}
+        initials_names={}
+        for i,institution in enumerate(institutions):
+            if institution["author"]=="":
+                continue
+            names,last_names=split_name(institution["author"])
+            key=name_key(last_names,names)
+            if not key[0]:
+                continue
+            index.setdefault(key,i)
+            short_key=initials_key(last_names,names)
+            initials_positions.setdefault(short_key,i)
+            initials_names.setdefault(short_key,set()).add(key)
+        authors_count={}
+        for author in authors:
+            short_key=initials_key(author["last_names"],author["first_names"])
+            authors_count[short_key]=authors_count.get(short_key,0)+1
+        initials_index={}
+        for short_key,i in initials_positions.items():
+            if len(initials_names[short_key])==1 and authors_count.get(short_key,0)<=1:
+                initials_index[short_key]=i
+        return index,initials_index
+
+    def match_institution(self,author,institutions,index,initials_index):
+        """
+        Finds the institution of an author. The full name is looked up first, then the last names
+        with the initials when they belong to a single author, and finally
+        the names are compared with fuzzy matching for the authors not found in the indexes
+
+        Returns
+        -------
+        institution : dict
+            The first institution of the author, None if not found
+        """
+        key=name_key(author["last_names"],author["first_names"])
+        if key in index.keys():
+            return institutions[index[key]]
+        short_key=initials_key(author["last_names"],author["first_names"])
+        if short_key in initials_index.keys():
+            return institutions[initials_index[short_key]]
+        for institution in institutions:
+            if institution["author"]=="":
+                continue
+            if fuzz.token_set_ratio(author["full_name"],institution["author"])>=80:
+                return institution
+        return None
+
     def parse_institutions(self,register):
         """
         Transforms the raw register institution informatio from web of science in the CoLav standard.
@@ -379,66 +390,12 @@ class WebOfScience():
         inst=[]
         #if "" in register.keys(): inst[""]=register[""]
         if "C1" in register.keys():
-            #print(register["C1"].rstrip().split("\n"))
-            C1=register["C1"].strip().replace(".","")
-            for auwaf in C1.split("\n"):
-                aulen=len(auwaf.split(";"))
-                if aulen==1:
-                    auaff=auwaf.split("] ")
-                    if len(auaff)==1:
-                        aff=auwaf
-                        authors=[""]
-                        if "AF" in register.keys():
-                            if len(register["AF"].rstrip().split("\n"))==1:
-                                authors=register["AF"].rstrip()
-                    else:
-                        aff=auaff[1]
-                        authors=[auaff[0][1:]]
-                else:
-                    aff=auwaf.split("] ")[1]
-                    authors=auwaf.split("] ")[0][1:].split("; ")
+            for authors,aff in wos_register(register).c1:
                 try:
                     name="".join(aff.split(", ")[0])
                 except:
                     name=""
-                if aff.split(", ")[-1].replace(".","").upper()=="ENGLAND":
-                    country="GB"
-                elif aff.split(", ")[-1].replace(".","").upper()=="CZECH REPUBLIC":
-                    country="CZ"
-                elif aff.split(", ")[-1].replace(".","").upper()=="VENEZUELA":
-                    country="VE"
-                elif aff.split(", ")[-1].replace(".","").upper()=="VIETNAM":
-                    country="VN"
-                elif aff.split(", ")[-1].replace(".","").upper()=="RUSSIA":
-                    country="RU"
-                elif aff.split(", ")[-1].replace(".","").upper()=="PEOPLES R CHINA":
-                    country="CN"
-                elif aff.split(", ")[-1].replace(".","").upper()=="SCOTLAND":
-                    country="GB"
-                elif aff.split(", ")[-1].replace(".","").upper()=="IRAN":
-                    country="IR"
-                elif aff.split(", ")[-1].replace(".","").upper()=="SOUTH KOREA":
-                    country="KR"
-                elif aff.split(", ")[-1].replace(".","").upper()=="U ARAB EMIRATES":
-                    country="AE"
-                elif aff.split(", ")[-1].replace(".","").upper()=="DEM REP CONGO":
-                    country="CD"
-                elif aff.split(", ")[-1].replace(".","").upper()=="TANZANIA":
-                    country="TZ"
-                elif aff.split(", ")[-1].replace(".","").upper()=="TAIWAN":
-                    country="TW"
-                elif aff.split(", ")[-1].replace(".","").upper()=="WALES":
-                    country="GB"
-                elif aff.split(", ")[-1].replace(".","").upper()=="MICRONESIA":
-                    country="FM"
-                elif aff.split(", ")[-1].replace(".","").upper()[-3:]=="USA":
-                    country="US"
-                else:
-                    try:
-                        country=iso3166.countries_by_name.get(aff.split(", ")[-1].replace(".","").upper()).alpha2
-                    except:
-                        #print("could not parse: ",aff.split(", ")[-1].replace(".","").upper())
-                        country=""
+                country=resolve_country(aff.split(", ")[-1],usa_suffix=True)
                 for i in range(len(authors)):
                     author=authors[i] if authors else ""
                     entry_aff={"name":name,
@@ -0,0 +1,193 @@
+import re
+from threading import local
+from unidecode import unidecode
+
+def valid(register,key):
+    '''
+    Checks that a field exists in the register and it is not empty or NaN
+    '''
+    return key in register.keys() and register[key] and register[key]==register[key]
+
+def text(register,key):
+    '''
+    Value of a text field, empty if it does not exist, it is empty, NaN or not a string
+    '''
+    if valid(register,key) and isinstance(register[key],str):
+        return register[key]
+    return ""
+
+def split_lines(register,key):
+    '''
+    Lines of a multi-line field, empty if the field is missing or not valid
+    '''
+    value=text(register,key).rstrip()
+    if not value:
+        return []
+    return value.split("\n")
+
+def split_ids(register,key):
+    '''
+    Entries of the RI or OI fields ("name/id" separated by ";"), parsed as (name, id) tuples
+    '''
+    ids=[]
+    if not text(register,key):
+        return ids
+    for res in register[key].rstrip().replace("; ",";").split(";"):
+        if not res:
+            continue
+        try:
+            name,idx=res.split("/")[-2:]
+        except Exception as e:
+            print("Could not split name and id in {} field on ".format(key),register.get("doi_idx"))
+            print(e)
+            continue
+        ids.append((name,idx))
+    return ids
+
+def split_name(au):
+    '''
+    Splits a name in the "last names, first names" format of the AF field and the C1 author lists
+
+    Returns
+    -------
+    (names, last_names) : tuple
+        First names and last names, capitalized
+    '''
+    raw_name=au.split(", ")
+    if len(raw_name)==1:
+        names=raw_name[0].capitalize()
+        last_names=""
+    elif len(raw_name)>2:
+        names=" ".join(raw_name[:-1]).rstrip().capitalize()
+        last_names=raw_name[-1].capitalize()
+    else:
+        names=raw_name[1].capitalize()
+        last_names=raw_name[0].capitalize()
+    return names,last_names
+
+def normalize_name(name):
+    '''
+    Lowercase name without accents, spaces or punctuation
+    '''
+    return re.sub(r"[^a-z]","",unidecode(name).lower())
+
+def name_key(last_names,names):
+    '''
+    Key used to match an author with the C1 author lists: the normalized last names and first names.
+    The same author written as "Perez-Gomez, Juan Carlos" and "Pérez Gómez, Juan Carlos" have the same key
+    '''
+    return (normalize_name(last_names),normalize_name(names))
+
+def initials_key(last_names,names):
+    '''
+    Looser key with the normalized last names and the initials of the first names,
+    "Perez-Gomez, Juan C" and "Pérez Gómez, Juan Carlos" have the same key
+    '''
+    initials="".join([i[0] for i in re.split(r"[^A-Z]+",unidecode(names).upper()) if i])
+    return (normalize_name(last_names),initials)
+
+def split_affiliations(register,af):
+    '''
+    Splits the C1 field in the addresses with their authors.
+    Each line is "[author; author] address" or only the address, in that case the address belongs
+    to the only author of the document if there is one.
+
+    Returns
+    -------
+    c1 : list
+        Tuples (list of authors, address), the list of authors is [""] when they are unknown
+    '''
+    c1=[]
+    if not text(register,"C1").strip():
+        return c1
+    C1=register["C1"].strip().replace(".","")
+    for auwaf in C1.split("\n"):
+        aulen=len(auwaf.split(";"))
+        if aulen==1:
+            auaff=auwaf.split("] ")
+            if len(auaff)==1:
+                aff=auwaf
+                authors=[""]
+                if af and len(af)==1:
+                    authors=[af[0]]
+            else:
+                aff=auaff[1]
+                authors=[auaff[0][1:]]
+        else:
+            aff=auwaf.split("] ")[1]
+            authors=auwaf.split("] ")[0][1:].split("; ")
+        c1.append((authors,aff))
+    return c1
+
+class WosRegister():
+    def __init__(self,register):
+        '''
+        Tokenized view of a register in the Web of Science tagged format (also used by Scielo).
+        The multi-line and multi-value fields are split the first time they are used and
+        shared by all the parse methods.
+
+        Attributes
+        ----------
+        au, af, ba : list
+            Lines of the AU, AF and BA fields, empty if the field is missing or not valid
+        researchids, orcids : list
+            Tuples (name, id) of the RI and OI fields
+        corresponding_last_name : str
+            Last name of the corresponding author from the RP field
+        email : str
+            EM field, empty if missing
+        c1 : list
+            Tuples (list of authors, address) of the C1 field
+        '''
+        self.register=register
+        self.fields={}
+
+    def field(self,name,function,*args):
+        if not name in self.fields.keys():
+            self.fields[name]=function(*args)
+        return self.fields[name]
+
+    @property
+    def au(self):
+        return self.field("au",split_lines,self.register,"AU")
+
+    @property
+    def af(self):
+        return self.field("af",split_lines,self.register,"AF")
+
+    @property
+    def ba(self):
+        return self.field("ba",split_lines,self.register,"BA")
+
+    @property
+    def researchids(self):
+        return self.field("researchids",split_ids,self.register,"RI")
+
+    @property
+    def orcids(self):
+        return self.field("orcids",split_ids,self.register,"OI")
+
+    @property
+    def corresponding_last_name(self):
+        return text(self.register,"RP").split(",")[0]
+
+    @property
+    def email(self):
+        return text(self.register,"EM").rstrip()
+
+    @property
+    def c1(self):
+        return self.field("c1",split_affiliations,self.register,self.af)
+
+#Last register tokenized by each thread, the parse methods of a register are called one after the other
+tokenized=local()
+
+def wos_register(register):
+    '''
+    Returns the tokenized view of a register, it is built only once while the same register is being parsed
+    '''
+    last=getattr(tokenized,"view",None)
+    if last is None or not last.register is register:
+        last=WosRegister(register)
+        tokenized.view=last
+    return last
@@ -0,0 +1,46 @@
+from Kahi.KahiCache import EntityCache, field_values
+
+def test_field_values():
+    author={"_id":1,"aliases":["juan perez","j perez"],"external_ids":[{"source":"orcid","value":"0000-1"},{"source":"scopus","value":""}]}
+    assert field_values(author,"external_ids.value")==["0000-1"]
+    assert field_values(author,"aliases")==["juan perez","j perez"]
+    assert field_values(author,"serials.value")==[]
+
+def test_put_and_get():
+    cache=EntityCache()
+    assert cache.get("authors","aliases","juan perez")==(False,None)
+    author={"_id":1,"aliases":["juan perez"],"external_ids":[{"source":"orcid","value":"0000-1"}]}
+    cache.put("authors",author)
+    found,entity=cache.get("authors","external_ids.value","0000-1")
+    assert found and entity==author
+    #the cache returns copies
+    entity["aliases"].append("other")
+    assert cache.get("authors","aliases","juan perez")[1]["aliases"]==["juan perez"]
+
+def test_misses_are_overwritten():
+    cache=EntityCache()
+    cache.put_missing("sources","serials.value","1234-5678")
+    assert cache.get("sources","serials.value","1234-5678")==(True,None)
+    cache.put("sources",{"_id":2,"serials":[{"type":"issn","value":"1234-5678"}]})
+    assert cache.get("sources","serials.value","1234-5678")[1]["_id"]==2
+    #a late miss does not hide the entity
+    cache.put_missing("sources","serials.value","1234-5678")
+    assert cache.get("sources","serials.value","1234-5678")[1]["_id"]==2
+
+def test_update_registers_new_keys():
+    cache=EntityCache()
+    cache.put("institutions",{"_id":3,"external_ids":[{"source":"ror","value":"https://ror.org/1"}]})
+    cache.update("institutions",3,{"external_ids":[{"source":"ror","value":"https://ror.org/1"},{"source":"grid","value":"grid.1"}]})
+    found,entity=cache.get("institutions","external_ids.value","grid.1")
+    assert found and entity["_id"]==3
+    #entities not cached are left to the database
+    cache.update("institutions",4,{"name":"other"})
+    assert cache.get("institutions","external_ids.value","other")==(False,None)
+
+def test_bounded_size():
+    cache=EntityCache(max_size=2)
+    for i in range(5):
+        cache.put("authors",{"_id":i,"aliases":["author {}".format(i)]})
+    assert len(cache.entities)<=2 and len(cache.keys)<=2
+    assert cache.get("authors","aliases","author 0")==(False,None)
+    assert cache.get("authors","aliases","author 4")[1]["_id"]==4
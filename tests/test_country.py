@@ -0,0 +1,32 @@
+from Kahi.KahiCountry import resolve_country, find_countries
+from Kahi.Scopus.Scopus import Scopus
+
+def test_resolve_country():
+    assert resolve_country("Colombia")=="CO"
+    assert resolve_country("Peoples R China")=="CN"
+    assert resolve_country("England")=="GB"
+    assert resolve_country("Bolivia")=="BO"
+    assert resolve_country("COL")=="CO"
+    assert resolve_country("CA 94305 USA",usa_suffix=True)=="US"
+    assert resolve_country("CA 94305 USA")==""
+    assert resolve_country("NC")==""
+    assert resolve_country("")==""
+
+def test_find_countries_whole_phrase():
+    assert [code for _,_,code in find_countries("Univ Antioquia, Medellin, Colombia")]==["CO"]
+    assert find_countries("New Jersey")==[]
+    assert find_countries("Georgia Institute of Technology")==[]
+
+def test_split_affiliations_regressions():
+    parser=Scopus()
+    text="University of New Mexico, Albuquerque, NM, United States"
+    assert parser.split_affiliations(text)==[(text,"US")]
+    assert parser.split_affiliations("New Jersey")==[("New Jersey","")]
+    assert parser.split_affiliations("Georgia Institute of Technology")==[("Georgia Institute of Technology","")]
+    assert parser.split_affiliations("Mexico City, Mexico")==[("Mexico City, Mexico","MX")]
+
+def test_split_affiliations_several_countries():
+    parser=Scopus()
+    text="Univ Nacl, Bogota, Colombia, Harvard Univ, Cambridge, United States"
+    assert parser.split_affiliations(text)==[("Univ Nacl, Bogota, Colombia","CO"),
+                                             ("Harvard Univ, Cambridge, United States","US")]
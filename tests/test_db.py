@@ -0,0 +1,131 @@
+import mongomock
+import pytest
+import Kahi.KahiDb as KahiDb
+from Kahi.KahiSimilarity import SimilarityPool
+
+@pytest.fixture
+def kahi_db(monkeypatch):
+    monkeypatch.setattr(KahiDb,"MongoClient",mongomock.MongoClient)
+    return KahiDb.KahiDb(colav_db="colav_test",n_jobs=1,verbose=0)
+
+def linked_register(doi,source="wos",ts=1):
+    return {"document":{"titles":[{"title":"A title","lang":"en"}],"abstract":"",
+                        "external_ids":[{"source":"doi","id":doi}],
+                        "source_checked":[{"source":source,"ts":ts}]},
+            "source":{"title":"A journal","serials":[]},
+            "author_institutions":[{"full_name":"John Doe","external_ids":[],"aliases":[],"corresponding":True,
+                                    "affiliations":[{"name":"Univ X","external_ids":[]}]}]}
+
+def test_merge_keeps_entities(kahi_db):
+    db=kahi_db.db
+    kahi_db.insert_one(linked_register("10.1/x"),merge=True)
+    assert db["documents"].count_documents({})==1
+    register=linked_register("10.1/x",ts=2)
+    register["document"]["abstract"]="An abstract"
+    kahi_db.insert_one(register,merge=True)
+    kahi_db.insert_one(linked_register("10.1/x",source="scopus",ts=3),merge=True)
+    assert db["documents"].count_documents({})==1
+    assert db["sources"].count_documents({})==1
+    assert db["authors"].count_documents({})==1
+    assert db["institutions"].count_documents({})==1
+    document=db["documents"].find_one({})
+    assert document["abstract"]=="An abstract"
+    assert document["source"]["id"]==db["sources"].find_one({})["_id"]
+    assert document["authors"][0]["id"]==db["authors"].find_one({})["_id"]
+    assert document["source_checked"]==[{"source":"wos","ts":2},{"source":"scopus","ts":3}]
+    assert document["external_ids"]==[{"source":"doi","id":"10.1/x"}]
+
+def test_merge_applies_linked_modifications(kahi_db):
+    db=kahi_db.db
+    kahi_db.insert_one(linked_register("10.1/x"),merge=True)
+    author=db["authors"].find_one({})
+    institution=db["institutions"].find_one({})
+    source=db["sources"].find_one({})
+    register=linked_register("10.1/x",ts=2)
+    orcid={"source":"orcid","value":"0000-0001"}
+    register["source"]={"id":source["_id"],"mod":{"serials":[{"type":"issn","value":"1234-5678"}]}}
+    register["author_institutions"]=[
+        {"id":author["_id"],"mod":{"external_ids":[orcid]},"corresponding":True,
+         "affiliations":[{"id":institution["_id"],"mod":{"external_ids":[{"source":"ror","value":"https://ror.org/1"}]}},
+                         {"name":"Univ Y","external_ids":[]}]},
+        {"full_name":"Jane Roe","external_ids":[],"aliases":[],"corresponding":False,"affiliations":[]}]
+    kahi_db.insert_one(register,merge=True)
+    assert db["authors"].find_one({"_id":author["_id"]})["external_ids"]==[orcid]
+    assert db["institutions"].find_one({"_id":institution["_id"]})["external_ids"][0]["source"]=="ror"
+    assert db["sources"].find_one({"_id":source["_id"]})["serials"][0]["value"]=="1234-5678"
+    #the new entities are not inserted and the document keeps its references
+    assert db["authors"].count_documents({})==1
+    assert db["institutions"].count_documents({})==1
+    document=db["documents"].find_one({})
+    assert document["authors"]==[{"id":author["_id"],"affiliations":[{"id":institution["_id"]}],"corresponding":True}]
+
+def test_insert_without_merge(kahi_db):
+    kahi_db.insert_one(linked_register("10.1/x"))
+    kahi_db.insert_one(linked_register("10.1/x"))
+    assert kahi_db.db["documents"].count_documents({})==2
+
+def test_close_stops_empty_similarity_pool(kahi_db):
+    pool=SimilarityPool(2)
+    pool.load("wos",["A title"],["A journal"],[2020])
+    kahi_db.similarity_pool=pool
+    kahi_db.remove_similarity("wos",0)
+    assert len(pool)==0
+    workers=list(pool.workers)
+    kahi_db.close()
+    assert kahi_db.similarity_pool is None
+    assert not any([worker.is_alive() for worker in workers])
+
+class FakeRor():
+    '''
+    Answers the ROR requests with the given responses and records the names requested
+    '''
+    def __init__(self,responses):
+        self.responses=responses
+        self.requested=[]
+
+    def resolve_many(self,names):
+        self.requested.extend(names)
+        return {name:self.responses.get(name,{"number_of_results":0,"items":[]}) for name in names}
+
+    def close(self):
+        pass
+
+def ror_response(organization):
+    return {"number_of_results":1,"items":[{"score":1.0,"organization":organization}]}
+
+def test_prefetch_entities(kahi_db):
+    db=kahi_db.db
+    institution_id=db["institutions"].insert_one({"name":"Univ X","external_ids":[{"source":"grid","value":"grid.1"}]}).inserted_id
+    db["sources"].insert_one({"title":"A journal","serials":[{"type":"pissn","value":"1234"}],"institution":"Publisher Inst"})
+    kahi_db.ror=FakeRor({"Univ X":ror_response({"external_ids":{"GRID":{"preferred":"grid.1"}}}),
+                         "Univ Y":ror_response({"external_ids":{}})})
+    register=linked_register("10.1/x")
+    register["source"]["serials"]=[{"type":"pissn","value":"1234"}]
+    register["author_institutions"][0]["affiliations"]=[{"name":"Univ X","external_ids":[]},
+                                                       {"name":"Univ Y","external_ids":[]},
+                                                       {"name":"Univ Z","external_ids":[{"source":"grid","value":"grid.2"}]}]
+    kahi_db.prefetch_entities([register])
+    assert sorted(kahi_db.ror.requested)==["Publisher Inst","Univ X","Univ Y"]
+    found,institution=kahi_db.entity_cache.get("institutions","external_ids.value","grid.1")
+    assert found and institution["_id"]==institution_id
+
+def test_iter_doi_ids_from_collection(kahi_db):
+    raw=kahi_db.client["wos_raw"]["stage"]
+    ids=raw.insert_many([{"doi_idx":"10.1/X{}".format(i)} for i in range(25)]).inserted_ids
+    kahi_db.db["documents"].insert_one({"external_ids":[{"source":"doi","id":"10.1/x3"}]})
+    found=list(kahi_db.iter_doi_ids_from_collection("wos_raw","stage","doi_idx",chunk_size=4))
+    assert found==[(ids[i],"10.1/x{}".format(i)) for i in range(25) if i!=3]
+    found=list(kahi_db.iter_doi_ids_from_collection("wos_raw","stage","doi_idx",start_id=ids[20],chunk_size=4))
+    assert [doi for idx,doi in found]==["10.1/x{}".format(i) for i in range(21,25)]
+
+def test_has_collscan():
+    ixscan={"stage":"FETCH","inputStage":{"stage":"IXSCAN","indexName":"doi_idx_1"}}
+    assert not KahiDb.has_collscan({"winningPlan":ixscan,"rejectedPlans":[{"stage":"COLLSCAN"}]})
+    assert KahiDb.has_collscan({"winningPlan":{"stage":"SHARD_MERGE","shards":[{"winningPlan":ixscan},{"winningPlan":{"stage":"COLLSCAN"}}]}})
+
+def test_ensure_indexes(kahi_db):
+    kahi_db.ensure_indexes(check=False)
+    kahi_db.ensure_indexes(check=False)
+    for db,collection,field in kahi_db.index_specs():
+        keys=[[key for key,order in index["key"]] for index in db[collection].index_information().values()]
+        assert [field] in keys,(db.name,collection,field)
@@ -0,0 +1,38 @@
+import mongomock
+from Kahi.KahiJournal import RunJournal
+
+def test_boundary_moves_with_contiguous_batches():
+    db=mongomock.MongoClient()["colav_test"]
+    journal=RunJournal(db,"run")
+    first=journal.add_batch([1,2,3])
+    second=journal.add_batch([4,5])
+    third=journal.add_batch([6])
+    #batches finishing out of order do not move the boundary
+    journal.commit_batch(second)
+    assert journal.boundary is None
+    assert journal.processed_keys()=={4,5}
+    journal.commit_batch(first)
+    assert journal.boundary==5
+    assert journal.processed_keys()==set()
+    journal.commit_batch(third)
+    assert journal.boundary==6
+    assert db["etl_journal"].find_one({"_id":"run"})["processed"]==6
+
+def test_resume_and_finish():
+    db=mongomock.MongoClient()["colav_test"]
+    journal=RunJournal(db,"run")
+    first=journal.add_batch([1,2])
+    second=journal.add_batch([3,4])
+    third=journal.add_batch([5])
+    journal.commit_batch(first)
+    journal.commit_batch(third)
+    #the run was interrupted, the new journal resumes it
+    journal=RunJournal(db,"run")
+    assert journal.boundary==2
+    assert journal.processed_keys()=={5}
+    journal.finish()
+    assert db["etl_journal_items"].count_documents({"run":"run"})==0
+    #a finished run starts again from the beginning
+    journal=RunJournal(db,"run")
+    assert journal.boundary is None
+    assert journal.processed_keys()==set()
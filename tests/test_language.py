@@ -0,0 +1,31 @@
+import pytest
+import langid.langid as langid
+from Kahi.KahiLanguage import LanguageDetector
+
+titles=["SEARCH FOR THE HIGGS BOSON IN THE DIPHOTON CHANNEL",
+        "Transmisión del dengue en Medellín, Colombia",
+        "Análise da pobreza no Brasil",
+        "A new method for protein structure prediction with deep learning",
+        "Étude de la transmission du paludisme en Afrique"]
+
+def test_classify_same_as_langid():
+    detector=LanguageDetector()
+    for title in titles:
+        lang,score=detector.classify(title)
+        expected=langid.classify(title)
+        assert lang==expected[0]
+        assert score==pytest.approx(expected[1])
+
+def test_classify_many_same_as_classify():
+    expected=[LanguageDetector().classify(title) for title in titles]
+    detector=LanguageDetector(chunk_size=2)
+    results=detector.classify_many(titles+titles[:2])
+    assert [lang for lang,score in results]==[lang for lang,score in expected+expected[:2]]
+    assert [score for lang,score in results]==pytest.approx([score for lang,score in expected+expected[:2]])
+    assert len(detector.cache)==len(titles)
+
+def test_cache_is_bounded():
+    detector=LanguageDetector(max_size=2)
+    detector.classify_many(titles)
+    assert len(detector.cache)==2
+    assert detector.classify(titles[-1])==detector.cache[" ".join(titles[-1].lower().split())]
@@ -0,0 +1,37 @@
+import mongomock
+from Kahi.KahiLoader import BulkLoader
+from Kahi.KahiCache import EntityCache
+
+def linked_register():
+    return {"document":{"titles":[{"title":"A title","lang":"en"}],"external_ids":[{"source":"doi","id":"10.1/x"}]},
+            "source":{"title":"A journal","serials":[]},
+            "author_institutions":[{"full_name":"John Doe","external_ids":[],"aliases":[],"corresponding":True,
+                                    "affiliations":[{"name":"Univ X","external_ids":[]}]}]}
+
+def test_add_and_flush():
+    db=mongomock.MongoClient()["colav"]
+    cache=EntityCache()
+    loader=BulkLoader(db,batch_size=100,cache=cache)
+    document_id=loader.add(linked_register())
+    assert db["documents"].count_documents({})==0
+    loader.flush()
+    document=db["documents"].find_one({"_id":document_id})
+    source=db["sources"].find_one({})
+    institution=db["institutions"].find_one({})
+    author=db["authors"].find_one({})
+    assert document["source"]=={"id":source["_id"]}
+    assert document["authors"]==[{"id":author["_id"],"affiliations":[{"id":institution["_id"]}],"corresponding":True}]
+    for entity in [source,institution,author]:
+        assert not "id" in entity.keys()
+    assert not "affiliations" in author.keys()
+
+def test_existing_entities_are_updated():
+    db=mongomock.MongoClient()["colav"]
+    source_id=db["sources"].insert_one({"title":"A journal"}).inserted_id
+    loader=BulkLoader(db,batch_size=1)
+    register=linked_register()
+    register["source"]={"id":source_id,"mod":{"publisher":"Someone"}}
+    document_id=loader.add(register)
+    loader.flush()
+    assert db["sources"].find_one({"_id":source_id})=={"_id":source_id,"title":"A journal","publisher":"Someone"}
+    assert db["documents"].find_one({"_id":document_id})["source"]=={"id":source_id}
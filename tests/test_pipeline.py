@@ -0,0 +1,48 @@
+import threading
+import pytest
+from Kahi.KahiPipeline import Pipeline, batched, transform_pool, transform_batch
+
+def test_batched():
+    assert list(batched(range(5),2))==[[0,1],[2,3],[4]]
+    assert list(batched([],2))==[]
+
+def test_pipeline_order_and_results():
+    pipeline=Pipeline([("double",lambda x:2*x,1),("odd",lambda x:x+1,1)],queue_size=2)
+    assert list(pipeline.run(range(10)))==[2*i+1 for i in range(10)]
+
+def test_pipeline_several_workers():
+    pipeline=Pipeline([("double",lambda x:2*x,3),("drop",lambda x:None if x%4 else x,2)],queue_size=2)
+    assert sorted(pipeline.run(range(100)))==[2*i for i in range(100) if (2*i)%4==0]
+
+def test_pipeline_error():
+    def fail(x):
+        if x==50:
+            raise ValueError("bad item")
+        return x
+    pipeline=Pipeline([("fail",fail,2),("same",lambda x:x,1)],queue_size=2)
+    with pytest.raises(ValueError):
+        list(pipeline.run(range(1000)))
+
+def test_transform_pool():
+    with transform_pool(1) as executor:
+        assert executor._mp_context.get_start_method()=="spawn"
+        assert executor.submit(transform_batch,[]).result()==[]
+
+def test_pipeline_consumer_stops_early():
+    before=threading.active_count()
+    pipeline=Pipeline([("same",lambda x:x,2),("same2",lambda x:x,2)],queue_size=1)
+    results=pipeline.run(iter(range(100000)))
+    for item in results:
+        if item>=5:
+            break
+    results.close()
+    assert pipeline.stop.is_set()
+    assert threading.active_count()==before
+
+def test_pipeline_consumer_raises():
+    before=threading.active_count()
+    pipeline=Pipeline([("same",lambda x:x,1)],queue_size=1)
+    with pytest.raises(RuntimeError):
+        for item in pipeline.run(range(100000)):
+            raise RuntimeError("consumer failed")
+    assert threading.active_count()==before
@@ -0,0 +1,44 @@
+import json
+from Kahi.KahiRor import RorResolver, RorDumpResolver, normalize_affiliation
+
+class FailingResolver(RorResolver):
+    '''
+    Resolver that answers without the service and fails for the names with "fail"
+    '''
+    def request(self,token):
+        self.requested.append(token)
+        if "fail" in token:
+            raise NameError("Server responded with status error: 500")
+        return {"number_of_results":1,"items":[{"score":1.0,"organization":{"name":token}}]},True
+
+def test_normalize_affiliation():
+    assert normalize_affiliation("Universidad de Antioquia, Medellín.")=="universidad de antioquia medellin"
+
+def test_resolve_many_with_failures():
+    resolver=FailingResolver()
+    resolver.requested=[]
+    results=resolver.resolve_many(["Univ X","Univ fail","Univ X","","Univ  x."])
+    assert results["Univ X"]["items"][0]["organization"]["name"]=="Univ X"
+    assert results["Univ  x."]==results["Univ X"]
+    assert results["Univ fail"]=={"number_of_results":0}
+    assert results[""]=={"number_of_results":0}
+    assert sorted(resolver.requested)==["Univ X","Univ fail"]
+    #the successful names are cached and the failed ones are requested again
+    resolver.resolve_many(["Univ X","Univ fail"])
+    assert sorted(resolver.requested)==["Univ X","Univ fail","Univ fail"]
+    resolver.close()
+
+def test_dump_resolver(tmp_path):
+    dump=[{"id":"https://ror.org/1","name":"Universidad de Antioquia","aliases":[],"acronyms":["UdeA"],"labels":[],
+           "external_ids":{"GRID":{"preferred":"grid.412881.6"}}},
+          {"id":"https://ror.org/2","name":"Universidad Nacional de Colombia","aliases":[],"acronyms":["UNAL"],"labels":[],
+           "external_ids":{"GRID":{"preferred":"grid.10689.36"}}}]
+    dump_file=tmp_path/"ror.json"
+    dump_file.write_text(json.dumps(dump))
+    resolver=RorDumpResolver(str(dump_file))
+    result=resolver.resolve("Fac Med, Universidad de Antioquia, Medellin, Colombia")
+    assert result["items"][0]["score"]==1.0
+    assert result["items"][0]["organization"]["id"]=="https://ror.org/1"
+    result=resolver.resolve("Univ Nacional de Colombia")
+    assert result["items"][0]["organization"]["id"]=="https://ror.org/2"
+    assert resolver.resolve("Something else entirely")["number_of_results"]==0
@@ -0,0 +1,173 @@
+import random
+import pytest
+from fuzzywuzzy import fuzz
+from Kahi.KahiDb import colav_similarity
+from Kahi.KahiSimilarity import SimilarityPool, SimilarityIndex, prepare_candidates, prepared_similarity_batch, colav_similarity_batch
+
+titles=["Measurement of the top quark mass in proton collisions",
+        "Dengue virus transmission dynamics in Medellin Colombia",
+        "A new method for protein structure prediction with deep learning",
+        "Measurement of the top quark mass in proton collisions"]
+sources=["Physics Letters B","Plos One","Nature","Physics Letters B"]
+years=[2019,2020,2021,2019]
+
+@pytest.fixture
+def pool():
+    pool=SimilarityPool(2)
+    pool.load("wos",titles,sources,years)
+    yield pool
+    pool.close()
+
+def test_pool_query(pool):
+    assert len(pool)==4
+    assert pool.query("wos","Dengue virus transmission dynamics in Medellin, Colombia","Plos One",2020)==1
+    #the first match in the lists order is returned, even if it is in another worker
+    assert pool.query("wos",titles[0],sources[0],2019)==0
+    assert pool.query("wos","Something completely different about economics","Journal",2020) is None
+    assert pool.query("scopus",titles[1],sources[1],2020) is None
+
+def test_pool_remove(pool):
+    pool.remove("wos",0)
+    assert pool.size("wos")==3
+    assert pool.query("wos",titles[0],sources[0],2019)==3
+    pool.remove("wos",3)
+    assert pool.query("wos",titles[0],sources[0],2019) is None
+    assert len(pool)==2
+
+def test_pool_survives_bad_queries(pool):
+    assert pool.query("wos",3.5,["not","a","string"],2019) is None
+    assert pool.query("wos",None,None,None) is None
+    assert all([worker.is_alive() for worker in pool.workers])
+    assert pool.query("wos",titles[2],sources[2],2021)==2
+
+def test_pool_close():
+    pool=SimilarityPool(2)
+    workers=list(pool.workers)
+    assert all([worker._start_method=="spawn" for worker in workers])
+    pool.close()
+    assert not any([worker.is_alive() for worker in workers])
+
+corpus=[
+    ("Measurement of the top quark mass in proton collisions","Physics Letters B",2019),
+    ("Dengue virus transmission dynamics in Medellin Colombia","Plos One",2020),
+    ("On AI","Nature",2021),
+    ("Study of the use of it","Revista Colombiana",2018),
+    ("Análisis de la pobreza en Colombia [Poverty analysis in Colombia]","Lecturas de Economia",2017),
+    ("A new method for protein structure prediction with deep learning","Nature",None),
+    ("Top quark mass measurement","Physics Letters B",2019),
+    ("Use of it in the case of us","Revista Colombiana",2010),
+    ("Dengue virus transmission dynamics in Medellin, Colombia","Plos One",2021),
+    ("On AI","Nature",2021),
+]
+
+queries=[
+    ("Measurement of the top quark mass in proton collisions","Phys Lett B",2019),
+    ("Measurement of the top quark mass in proton collisions","Physics Letters B",None),
+    ("Dengue virus transmission dynamics in Medellin, Colombia","Plos One",2020),
+    ("On AI","Nature",2021),
+    ("On AI","Nature",None),
+    ("Study of the use of it","Revista Colombiana",2018),
+    ("Study of the use of IT","Revista Colombiana",""),
+    ("Poverty analysis in Colombia [Análisis de la pobreza en Colombia]","Lecturas de Economia",2017),
+    ("A new method for protein structure prediction with deep learning","Nature",2021),
+    ("Use of it in the case of us","Revista Colombiana",2015),
+    #long titles are accepted whatever the years are
+    ("Measurement of the top quark mass in proton collisions","Physics Letters B",2015),
+    ("Dengue virus transmission dynamics in Medellin Colombia","Plos One",2024),
+    ("A new method for protein structure prediction with deep learning","Nature",1999),
+    ("On AI","Nature",2019),
+    ("Something completely different about economics","Journal",2020),
+]
+
+def brute_force(title,source,year):
+    '''
+    First register of the corpus accepted by colav_similarity, as the full scan used to do
+    '''
+    for i,(title2,source2,year2) in enumerate(corpus):
+        if colav_similarity(title,title2,source,source2,year,year2):
+            return i
+    return None
+
+def test_blocking_same_as_full_scan():
+    titles,sources,years=zip(*corpus)
+    prepared=prepare_candidates(titles,sources,years)
+    index=SimilarityIndex()
+    for i in range(len(corpus)):
+        index.add(i,None,years[i],tokens=prepared["tokens"][i])
+    for title,source,year in queries:
+        candidates=index.candidates(title,year)
+        found=prepared_similarity_batch(title,source,year,prepared,candidates) if candidates else None
+        found=candidates[found] if not found is None else None
+        assert found==brute_force(title,source,year),title
+
+def test_batch_same_as_full_scan():
+    titles,sources,years=zip(*corpus)
+    for title,source,year in queries:
+        assert colav_similarity_batch(title,source,year,titles,sources,years)==brute_force(title,source,year),title
+
+def test_pool_same_as_full_scan():
+    titles,sources,years=zip(*corpus)
+    pool=SimilarityPool(3)
+    try:
+        pool.load("wos",list(titles),list(sources),list(years))
+        for title,source,year in queries:
+            assert pool.query("wos",title,source,year)==brute_force(title,source,year),title
+    finally:
+        pool.close()
+
+def random_pairs(n,seed=3):
+    '''
+    Pairs of titles with typos, truncations, case changes and extra or missing words,
+    with journals and years that match or not
+    '''
+    rng=random.Random(seed)
+    base=[title for title,source,year in corpus]+["The $\\\\alpha$-decay of heavy nuclei","Effects of El Niño on coffee crops"]
+    journals=["Physics Letters B","Phys Lett B","Plos One","Nature","Revista Colombiana","",None]
+    def mutate(title):
+        operation=rng.choice(["same","typo","truncate","upper","extra","drop"])
+        if operation=="typo":
+            i=rng.randrange(len(title))
+            return title[:i]+rng.choice("abcxyz")+title[i+1:]
+        if operation=="truncate":
+            return title[:max(3,int(len(title)*rng.uniform(0.6,0.95)))]
+        if operation=="upper":
+            return title.upper()
+        if operation=="extra":
+            return title+" "+rng.choice(["a review","in children","(preprint)"])
+        if operation=="drop":
+            words=title.split()
+            if len(words)>2:
+                del(words[rng.randrange(len(words))])
+            return " ".join(words)
+        return title
+    pairs=[]
+    for i in range(n):
+        title=rng.choice(base)
+        other=mutate(rng.choice([title,title,title,rng.choice(base)]))
+        pairs.append((title,other,rng.choice(journals),rng.choice(journals),rng.choice([2019,2020,None,"2019"]),rng.choice([2019,2020,None])))
+    return pairs
+
+def test_vectorized_scorer_same_as_colav_similarity():
+    #the parity needs the python-Levenshtein backend of fuzzywuzzy
+    assert fuzz.SequenceMatcher.__module__=="fuzzywuzzy.StringMatcher"
+    pairs=random_pairs(1000)
+    accepted=0
+    for title,other,source,other_source,year,other_year in pairs:
+        expected=colav_similarity(title,other,source,other_source,year,other_year)
+        accepted+=expected
+        found=colav_similarity_batch(title,source,year,[other],[other_source],[other_year])
+        assert (not found is None)==expected,(title,other,source,other_source,year,other_year)
+    assert 0<accepted<len(pairs)
+
+def test_prepared_rows_same_as_lists():
+    rng=random.Random(5)
+    pairs=random_pairs(200,seed=5)
+    titles=[other for title,other,source,other_source,year,other_year in pairs]
+    sources=[other_source for title,other,source,other_source,year,other_year in pairs]
+    years=[other_year for title,other,source,other_source,year,other_year in pairs]
+    prepared=prepare_candidates(titles,sources,years)
+    for title,other,source,other_source,year,other_year in pairs[:50]:
+        rows=sorted(rng.sample(range(len(titles)),40))
+        found=prepared_similarity_batch(title,source,year,prepared,rows)
+        expected=[k for k,i in enumerate(rows) if colav_similarity(title,titles[i],source,sources[i],year,years[i])]
+        assert found==(expected[0] if expected else None),title
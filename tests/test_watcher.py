@@ -0,0 +1,120 @@
+import pytest
+import mongomock
+from queue import Queue, Empty
+from threading import Event
+from Kahi import KahiDb, Kahi
+from Kahi.KahiWatcher import RawWatcher
+
+@pytest.fixture
+def kahi_db(monkeypatch):
+    monkeypatch.setattr(KahiDb,"MongoClient",mongomock.MongoClient)
+    return KahiDb.KahiDb(colav_db="colav_test",n_jobs=1,verbose=0)
+
+def drain(queue,n,timeout=5):
+    return [queue.get(timeout=timeout) for i in range(n)]
+
+def test_watcher_polls_after_watermark(kahi_db):
+    stage=kahi_db.raw_dbs["wos"][kahi_db.collection]
+    ids=stage.insert_many([{"doi_idx":"10.1/A"},{"doi_idx":"10.1/B"},{"doi_idx":""}]).inserted_ids
+    kahi_db.set_watermark("wos",ids[0])
+    queue=Queue()
+    stop=Event()
+    watcher=RawWatcher(kahi_db,"wos",queue,stop,use_change_streams=False,poll_interval=0.05)
+    watcher.start()
+    try:
+        assert drain(queue,2)==[("wos",ids[1],"10.1/b"),("wos",ids[2],"")]
+        #the registers inserted while the watcher runs are found in the next poll
+        idx=stage.insert_one({"doi_idx":"10.1/C"}).inserted_id
+        assert drain(queue,1)==[("wos",idx,"10.1/c")]
+        with pytest.raises(Empty):
+            queue.get(timeout=0.2)
+    finally:
+        stop.set()
+        watcher.join(5)
+    assert not watcher.thread.is_alive()
+
+def test_watcher_without_watermark_reads_everything(kahi_db):
+    lens=kahi_db.raw_dbs["lens"][kahi_db.collection]
+    idx=lens.insert_one({"external_ids":[{"type":"pmid","value":"1"},{"type":"doi","value":"10.1/X"}]}).inserted_id
+    queue=Queue()
+    stop=Event()
+    watcher=RawWatcher(kahi_db,"lens",queue,stop,use_change_streams=False,poll_interval=0.05)
+    watcher.start()
+    try:
+        assert drain(queue,1)==[("lens",idx,"10.1/x")]
+    finally:
+        stop.set()
+        watcher.join(5)
+
+class FakeStream():
+    '''
+    Change stream that returns the given events and then stops the watcher
+    '''
+    def __init__(self,events,stop):
+        self.events=list(events)
+        self.stop=stop
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        return False
+
+    def try_next(self):
+        if self.events:
+            return self.events.pop(0)
+        self.stop.set()
+        return None
+
+class FakeKahi():
+    def __init__(self,events,stop):
+        self.collection="stage"
+        self.db_suffix="_test"
+        self.stream=FakeStream(events,stop)
+        self.raw_dbs={"wos":{"stage":self}}
+        self.polled=[]
+
+    def watch(self,*args,**kwargs):
+        return self.stream
+
+    def get_watermark(self,db):
+        return None
+
+    def iter_new_raw_dois(self,db,field,start):
+        self.polled.append(start)
+        return []
+
+    def raw_doi(self,db,reg):
+        return reg.get("doi_idx","").lower()
+
+def test_watch_moves_the_mark():
+    stop=Event()
+    events=[{"fullDocument":{"_id":3,"doi_idx":"10.1/C"}},{"fullDocument":{"_id":5,"doi_idx":"10.1/E"}},
+            {"fullDocument":{"_id":1,"doi_idx":"10.1/A"}}]
+    kahi=FakeKahi(events,stop)
+    queue=Queue()
+    watcher=RawWatcher(kahi,"wos",queue,stop,poll_interval=0.05)
+    watcher.watch()
+    assert [queue.get_nowait() for i in range(3)]==[("wos",3,"10.1/c"),("wos",5,"10.1/e"),("wos",1,"10.1/a")]
+    #the update of an older register does not move the mark back
+    assert watcher.last==5
+    watcher.poll()
+    assert kahi.polled==[None,5]
+
+def test_kahi_watch_survives_a_failed_batch(monkeypatch):
+    monkeypatch.setattr(KahiDb,"MongoClient",mongomock.MongoClient)
+    etl=Kahi.Kahi(colav_db="colav_test",n_jobs=1,verbose=0)
+    stage=etl.raw_dbs["wos"][etl.collection]
+    stage.insert_many([{"doi_idx":"10.1/A"},{"doi_idx":"10.1/B"}])
+    batches=[]
+    def process_micro_batch(batch):
+        batches.append([doi for db,idx,doi in batch])
+        if len(batches)==1:
+            raise ValueError("bad batch")
+        etl.stop_watch()
+        return len(batch)
+    monkeypatch.setattr(etl,"process_micro_batch",process_micro_batch)
+    count=etl.watch(dbs=["wos"],batch_size=1,max_latency=0.05,use_change_streams=False,poll_interval=0.05)
+    #the failed batch is skipped, not processed again when stopping
+    assert batches==[["10.1/a"],["10.1/b"]]
+    assert count==1
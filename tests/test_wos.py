@@ -0,0 +1,86 @@
+import random
+import string
+from fuzzywuzzy import fuzz
+from Kahi.WebOfScience.WebOfScience import WebOfScience
+from Kahi.WebOfScience.WosRegister import wos_register
+
+def affiliation_names(authors):
+    return [(author["full_name"],[inst["name"] for inst in author["affiliations"]]) for author in authors]
+
+def fuzzy_affiliations(parser,register):
+    '''
+    Affiliations found comparing every author with every C1 author, as parse_authors_institutions used to do
+    '''
+    institutions=parser.parse_institutions(register)
+    result=[]
+    for author in parser.parse_authors(register):
+        found=[]
+        for institution in institutions:
+            if institution["author"] and fuzz.token_set_ratio(author["full_name"],institution["author"])>=80:
+                found=[institution["name"]]
+                break
+        result.append((author["full_name"],found))
+    return result
+
+def test_same_last_name_and_initial():
+    register={"PT":"J","AF":"Li, Xiaoming\nLi, Xue",
+              "C1":"[Li, Xiaoming] Tsinghua Univ, Beijing, Peoples R China.\n[Li, Xue] Univ Antioquia, Medellin, Colombia."}
+    authors=WebOfScience().parse_authors_institutions(register)
+    assert affiliation_names(authors)==[("Xiaoming Li",["Tsinghua Univ"]),("Xue Li",["Univ Antioquia"])]
+
+def test_initials_and_accents():
+    register={"PT":"J","AF":"Pérez-Gómez, Juan Carlos\nSmith, Anna Beth",
+              "C1":"[Perez Gomez, Juan C; Smith, Anna Beth] Univ Antioquia, Medellin, Colombia."}
+    authors=WebOfScience().parse_authors_institutions(register)
+    assert [names for _,names in affiliation_names(authors)]==[["Univ Antioquia"],["Univ Antioquia"]]
+
+def test_missing_authors():
+    register={"PT":"J","AF":"Doe, John\nRoe, Jane",
+              "C1":"[Doe, John] Univ Antioquia, Medellin, Colombia.\nUniv Nacl, Bogota, Colombia."}
+    authors=WebOfScience().parse_authors_institutions(register)
+    assert affiliation_names(authors)==[("John Doe",["Univ Antioquia"]),("Jane Roe",[]),("missing",["Univ Nacl"])]
+
+def test_same_result_as_fuzzy_matching():
+    random.seed(1)
+    def name():
+        return "".join(random.choice(string.ascii_lowercase) for _ in range(7)).capitalize()
+    af=["{}, {} {}".format(name(),name(),name()[0]) for _ in range(300)]
+    groups=[af[i:i+30] for i in range(0,len(af),30)]
+    c1="\n".join(["[{}] Inst {}, City, Colombia.".format("; ".join(group),k) for k,group in enumerate(groups)])
+    register={"PT":"J","AU":"\n".join(af),"AF":"\n".join(af),"C1":c1}
+    parser=WebOfScience()
+    assert affiliation_names(parser.parse_authors_institutions(dict(register)))==fuzzy_affiliations(parser,dict(register))
+
+def test_missing_and_nan_fields():
+    nan=float("nan")
+    register={"PT":"J","TI":nan,"AU":"Doe, J","AF":"Doe, John","BA":nan,"RI":nan,"OI":nan,"EM":nan,"RP":nan,
+              "C1":"Univ Antioquia, Medellin, Colombia."}
+    parser=WebOfScience()
+    document,authors,source=parser.parse_one(register)
+    assert document["author_count"]==1
+    assert affiliation_names(authors)==[("John Doe",["Univ Antioquia"])]
+    register={"PT":"B","BA":nan,"AF":nan,"C1":nan}
+    document,authors,source=parser.parse_one(register)
+    assert document["author_count"]==""
+    assert authors==[]
+
+def test_tokenized_register():
+    register={"PT":"J","AU":"Doe, J\nSmith, AB\n","AF":"Doe, John\nSmith, Anna Beth\n",
+              "RI":"Doe, John/A-1234-2010; Smith, Anna/B-999-2011\n","OI":"Smith, Anna/0000-0001-2345-6789\n",
+              "RP":"Smith, AB (corresponding author), Univ X","EM":"anna@univ.edu\n",
+              "C1":"[Doe, John; Smith, Anna Beth] Univ Antioquia, Medellin, Colombia.\n[Smith, Anna Beth] Stanford Univ, Stanford, CA 94305 USA."}
+    view=wos_register(register)
+    assert wos_register(register) is view
+    assert view.au==["Doe, J","Smith, AB"]
+    assert view.researchids==[("Doe, John","A-1234-2010"),("Smith, Anna","B-999-2011")]
+    assert view.orcids==[("Smith, Anna","0000-0001-2345-6789")]
+    assert view.corresponding_last_name=="Smith"
+    assert view.c1==[(["Doe, John","Smith, Anna Beth"],"Univ Antioquia, Medellin, Colombia"),
+                     (["Smith, Anna Beth"],"Stanford Univ, Stanford, CA 94305 USA")]
+    authors=WebOfScience().parse_authors(register)
+    assert [author["external_ids"] for author in authors]==[[{"source":"researchid","value":"A-1234-2010"}],
+                                                            [{"source":"researchid","value":"B-999-2011"},{"source":"orcid","value":"0000-0001-2345-6789"}]]
+    assert [(author["corresponding"],author["corresponding_email"]) for author in authors]==[(False,""),(True,"anna@univ.edu")]
+    institutions=WebOfScience().parse_institutions(register)
+    assert [(inst["name"],inst["author"],inst["addresses"][0]["country"]) for inst in institutions]==[
+        ("Univ Antioquia","Doe, John","CO"),("Univ Antioquia","Smith, Anna Beth","CO"),("Stanford Univ","Smith, Anna Beth","US")]